@@ -0,0 +1,364 @@
+"""main.py 性能基准测试
+
+生成WOS导出格式的模拟表格，按不同数据量测量核心函数的耗时和内存峰值，
+结果可保存为JSON并与基线比较。
+
+用法：
+    python benchmark.py run --sizes 1000 10000 100000 --output results.json
+    python benchmark.py run --baseline results.json
+    python benchmark.py generate data.xlsx --rows 10000 --college-mode address
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
+
+import main
+
+# ========== 模拟数据生成 ==========
+
+COLLEGES = [
+    '化学学院', '物理学院', '数学科学学院', '生命科学学院', '信息科学技术学院', '工学院',
+    '材料科学与工程学院', '环境科学与工程学院', '医学部', '心理与认知科学学院', '地球与空间科学学院', '城市与环境学院',
+]
+
+DEPARTMENTS = [
+    'Coll Chem & Mol Engn', 'Sch Phys', 'Sch Math Sci', 'Sch Life Sci', 'Sch Elect Engn & Comp Sci', 'Coll Engn',
+    'Sch Mat Sci & Engn', 'Coll Environm Sci & Engn', 'Hlth Sci Ctr', 'Sch Psychol & Cognit Sci',
+    'Sch Earth & Space Sci', 'Coll Urban & Environm Sci',
+]
+
+PARTNERS = ['Tsinghua Univ', 'Fudan Univ', 'Zhejiang Univ', 'Univ Sci & Technol China', 'Nanjing Univ']
+
+BASE_COLUMNS = ['序号', main.WOS_COLUMN, 'Article Title', 'Authors', 'Source Title', 'Publication Year',
+                '学院', 'DOI', 'Times Cited', 'Abstract']
+
+WORDS = ('catalytic synthesis quantum structure dynamics protein model network efficient novel analysis '
+         'high performance thin film cell signal response deep learning graph optimal control').split()
+
+BENCHMARK_FUNCTIONS = [
+    'get_colleges_from_data', 'filter_by_college_only', 'correct_deduplicate_and_filter',
+    'create_exact_copy_from_template', 'create_simple_excel',
+]
+
+
+def _sentence(rng, word_count):
+    return ' '.join(rng.choice(WORDS) for _ in range(word_count)).capitalize()
+
+
+def _address(rng):
+    """WOS地址：1~3个机构，每个机构前为方括号中的作者名单"""
+    parts = []
+    for _ in range(rng.randint(1, 3)):
+        authors = '; '.join(f"{rng.choice('ZWLCY')}{rng.randint(1, 99)}, {rng.choice('ABCDEFG')}"
+                            for _ in range(rng.randint(1, 3)))
+        if rng.random() < 0.8:
+            parts.append(f"[{authors}] Peking Univ, {rng.choice(DEPARTMENTS)}, Beijing 100871, Peoples R China")
+        else:
+            parts.append(f"[{authors}] {rng.choice(PARTNERS)}, {rng.choice(DEPARTMENTS)}, Shanghai, Peoples R China")
+    return '; '.join(parts)
+
+
+def make_wos_workbook(file_path, accession_ids, columns=len(BASE_COLUMNS), college_mode='college', seed=0):
+    """生成WOS导出格式的表格
+
+    accession_ids决定每行的WOS编号（用于构造重复数据）；columns为总列数，
+    超出基础列的部分以附加列补足；college_mode为college时学院列为单个学院名，
+    为address时为多机构的Addresses列。标题行和第一个数据行带有格式。
+    """
+    rng = random.Random(seed)
+    header = list(BASE_COLUMNS)
+    if college_mode == 'address':
+        header[header.index('学院')] = 'Addresses'
+    header += [f'Extra Field {idx}' for idx in range(1, columns - len(header) + 1)]
+    # 至少保留到学院列
+    header = header[:max(columns, BASE_COLUMNS.index('学院') + 1)]
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('savedrecs')
+    ws.column_dimensions['C'].width = 60
+    ws.column_dimensions['J'].width = 80
+    ws.row_dimensions[1].height = 24
+
+    thin = Side(style='thin')
+    header_cells = []
+    for name in header:
+        cell = WriteOnlyCell(ws, value=name)
+        cell.font = Font(name='Arial', bold=True, size=11)
+        cell.fill = PatternFill('solid', fgColor='DDEBF7')
+        cell.border = Border(left=thin, right=thin, top=thin, bottom=thin)
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+        header_cells.append(cell)
+    ws.append(header_cells)
+
+    for row_number, accession_id in enumerate(accession_ids, 1):
+        values = {
+            '序号': row_number,
+            main.WOS_COLUMN: f"WOS:{accession_id:015d}",
+            'Article Title': _sentence(rng, rng.randint(6, 14)),
+            'Authors': '; '.join(f"Author{rng.randint(1, 5000)}, {rng.choice('ABCDEFG')}." for _ in range(3)),
+            'Source Title': rng.choice(['NATURE', 'SCIENCE', 'J AM CHEM SOC', 'PHYS REV LETT', 'CELL']),
+            'Publication Year': rng.randint(2015, 2024),
+            '学院': rng.choice(COLLEGES),
+            'Addresses': _address(rng) if college_mode == 'address' else None,
+            'DOI': f"10.{rng.randint(1000, 9999)}/{accession_id}",
+            'Times Cited': rng.randint(0, 500),
+            'Abstract': _sentence(rng, rng.randint(20, 40)),
+        }
+        row = [values.get(name, f"value {rng.randint(0, 9999)}") for name in header]
+        if row_number == 1:
+            # 第一个数据行带格式，作为输出文件的数据行样式
+            styled_row = []
+            for value in row:
+                cell = WriteOnlyCell(ws, value=value)
+                cell.font = Font(name='Times New Roman', size=10)
+                cell.border = Border(bottom=thin)
+                styled_row.append(cell)
+            ws.append(styled_row)
+        else:
+            ws.append(row)
+
+    wb.save(file_path)
+    return file_path
+
+
+def make_dedup_pair(directory, rows, duplicate_ratio=0.3, columns=len(BASE_COLUMNS), college_mode='college', seed=0):
+    """生成主文件和查重文件，查重文件中duplicate_ratio比例的记录在主文件中已存在"""
+    rng = random.Random(seed)
+    main_ids = list(range(rows))
+    duplicate_count = int(rows * duplicate_ratio)
+    check_ids = rng.sample(main_ids, duplicate_count) + list(range(rows * 10, rows * 10 + rows - duplicate_count))
+    rng.shuffle(check_ids)
+
+    main_path = make_wos_workbook(os.path.join(directory, f'main_{rows}.xlsx'), main_ids, columns,
+                                  college_mode, seed)
+    check_path = make_wos_workbook(os.path.join(directory, f'check_{rows}.xlsx'), check_ids, columns,
+                                   college_mode, seed + 1)
+    return main_path, check_path
+
+
+# ========== 测量 ==========
+
+def reset_caches():
+    """清空main.py的内存缓存、列式副本和WOS索引，使下一次调用从读取文件开始"""
+    main._dataframe_cache.discard_where(lambda key: True)
+    main._template_profile_cache.discard_where(lambda key: True)
+    main._college_index_cache.discard_where(lambda key: True)
+    shutil.rmtree(main.SIDECAR_DIR, ignore_errors=True)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(main.WOS_INDEX_PATH + suffix):
+            os.remove(main.WOS_INDEX_PATH + suffix)
+
+
+def measure(func, repeat=3, memory=True):
+    """测量一个函数：首次调用（冷缓存）耗时、之后调用的耗时中位数和内存峰值"""
+    peak_mb = None
+    if memory:
+        # tracemalloc会明显拖慢执行，内存峰值单独测一次
+        reset_caches()
+        tracemalloc.start()
+        func()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+
+    reset_caches()
+    start = time.perf_counter()
+    func()
+    cold_seconds = time.perf_counter() - start
+
+    warm_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        warm_times.append(time.perf_counter() - start)
+
+    return {
+        'cold_seconds': round(cold_seconds, 4),
+        'warm_seconds': round(statistics.median(warm_times), 4) if warm_times else None,
+        'peak_mb': round(peak_mb, 2) if peak_mb is not None else None,
+    }
+
+
+def _check(result, error_index):
+    if result[error_index]:
+        raise RuntimeError(result[error_index])
+    return result
+
+
+def benchmark_cases(main_path, check_path, output_dir):
+    """各函数的测量用例，输入数据在这里预先读好，不计入读取之外的函数的耗时"""
+    main_df = main.read_excel_cached(main_path)
+    colleges, college_column = main.get_colleges_from_data(main_df)
+    college = colleges[0]
+    output_file = os.path.join(output_dir, 'benchmark_output.xlsx')
+
+    return {
+        'get_colleges_from_data': lambda: main.get_colleges_from_data(main_df),
+        'filter_by_college_only': lambda: _check(
+            main.filter_by_college_only(main_path, college, college_column), 3),
+        'correct_deduplicate_and_filter': lambda: _check(
+            main.correct_deduplicate_and_filter(check_path, main_path, college, college_column), 4),
+        'create_exact_copy_from_template': lambda: main.create_exact_copy_from_template(
+            main_path, main_df, output_file),
+        'create_simple_excel': lambda: main.create_simple_excel(main_df, output_file),
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, functions=BENCHMARK_FUNCTIONS, columns=len(BASE_COLUMNS), duplicate_ratio=0.3,
+                   college_mode='college', repeat=3, memory=True, workdir=None):
+    """按每个数据量生成数据并测量各函数，返回可保存为JSON的结果"""
+    import pandas as pd
+    import openpyxl
+
+    workdir = workdir or tempfile.mkdtemp(prefix='wos_benchmark_')
+    data_dir = os.path.join(workdir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    original_cwd = os.getcwd()
+    # main.py的缓存目录和索引都是相对路径，在临时目录中运行
+    os.chdir(workdir)
+    results = []
+    try:
+        for rows in sizes:
+            print(f"生成 {rows} 行的测试数据...", flush=True)
+            main_path, check_path = make_dedup_pair(data_dir, rows, duplicate_ratio, columns, college_mode)
+            cases = benchmark_cases(main_path, check_path, workdir)
+            for name in functions:
+                print(f"  {name} @ {rows} 行", flush=True)
+                results.append(dict(function=name, rows=rows, **measure(cases[name], repeat, memory)))
+    finally:
+        os.chdir(original_cwd)
+
+    return {
+        'meta': {
+            'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'openpyxl': openpyxl.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'columns': columns,
+            'duplicate_ratio': duplicate_ratio,
+            'college_mode': college_mode,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+# ========== 报告与基线比较 ==========
+
+def _format_value(value, unit):
+    return '-' if value is None else f"{value:.3f}{unit}" if unit == 's' else f"{value:.1f}{unit}"
+
+
+def print_report(report):
+    print(f"\n{'函数':<34}{'行数':>9}{'首次':>12}{'重复':>12}{'内存峰值':>12}")
+    for item in report['results']:
+        print(f"{item['function']:<34}{item['rows']:>9}"
+              f"{_format_value(item['cold_seconds'], 's'):>12}"
+              f"{_format_value(item['warm_seconds'], 's'):>12}"
+              f"{_format_value(item['peak_mb'], 'MB'):>12}")
+
+
+def compare_with_baseline(report, baseline, threshold=0.2):
+    """与基线逐项比较，返回超过阈值的退化项列表"""
+    baseline_items = {(item['function'], item['rows']): item for item in baseline['results']}
+    regressions = []
+    print(f"\n与基线比较（基线版本 {baseline['meta'].get('revision')}，阈值 {threshold:.0%}）:")
+    for key in ('columns', 'duplicate_ratio', 'college_mode'):
+        if baseline['meta'].get(key) != report['meta'].get(key):
+            print(f"  注意: 基线的 {key} 为 {baseline['meta'].get(key)}，本次为 {report['meta'].get(key)}")
+    for item in report['results']:
+        base = baseline_items.get((item['function'], item['rows']))
+        if base is None:
+            continue
+        changes = []
+        for metric in ('cold_seconds', 'warm_seconds', 'peak_mb'):
+            if not item.get(metric) or not base.get(metric):
+                continue
+            ratio = item[metric] / base[metric]
+            changes.append(f"{metric} {ratio - 1:+.0%}")
+            if ratio > 1 + threshold:
+                regressions.append((item['function'], item['rows'], metric, base[metric], item[metric]))
+        print(f"  {item['function']:<34}{item['rows']:>9}  {', '.join(changes)}")
+
+    for function, rows, metric, old, new in regressions:
+        print(f"退化: {function} @ {rows} 行 {metric}: {old} -> {new}")
+    return regressions
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description='main.py 性能基准测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='运行基准测试')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='数据行数')
+    run_parser.add_argument('--functions', nargs='+', choices=BENCHMARK_FUNCTIONS, default=BENCHMARK_FUNCTIONS)
+    run_parser.add_argument('--columns', type=int, default=len(BASE_COLUMNS), help='总列数')
+    run_parser.add_argument('--duplicate-ratio', type=float, default=0.3, help='查重文件中的重复比例')
+    run_parser.add_argument('--college-mode', choices=['college', 'address'], default='college')
+    run_parser.add_argument('--repeat', type=int, default=3, help='冷缓存之后的重复次数')
+    run_parser.add_argument('--no-memory', action='store_true', help='不测量内存峰值（节省一次执行）')
+    run_parser.add_argument('--workdir', help='数据和缓存目录，默认为临时目录')
+    run_parser.add_argument('--output', help='结果保存路径（JSON）')
+    run_parser.add_argument('--baseline', help='用于比较的基线结果（JSON）')
+    run_parser.add_argument('--threshold', type=float, default=0.2, help='判定退化的增幅阈值')
+
+    generate_parser = subparsers.add_parser('generate', help='只生成模拟表格')
+    generate_parser.add_argument('output', help='输出文件路径')
+    generate_parser.add_argument('--rows', type=int, default=10000)
+    generate_parser.add_argument('--columns', type=int, default=len(BASE_COLUMNS))
+    generate_parser.add_argument('--college-mode', choices=['college', 'address'], default='college')
+    generate_parser.add_argument('--start', type=int, default=0, help='WOS编号起始值')
+    generate_parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args(argv)
+    main.logger.setLevel(logging.WARNING)
+
+    if args.command == 'generate':
+        make_wos_workbook(args.output, range(args.start, args.start + args.rows), args.columns,
+                          args.college_mode, args.seed)
+        print(f"已生成 {args.output}（{args.rows} 行）")
+        return 0
+
+    report = run_benchmarks(args.sizes, args.functions, args.columns, args.duplicate_ratio,
+                            args.college_mode, args.repeat, not args.no_memory, args.workdir)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare_with_baseline(report, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
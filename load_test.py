@@ -0,0 +1,278 @@
+"""Web接口压力测试
+
+在本机启动应用（Flask测试客户端，或 --server 时启动本地HTTP服务），按真实使用流程
+并发回放会话：上传主文件和查重文件、获取学院统计、筛选若干学院并下载结果。
+统计每个接口的 p50/p95/p99 延迟和吞吐量，用于评估进程数配置和
+uploads/、outputs/ 目录上的争用。全程离线运行。
+
+用法：
+    python load_test.py --sessions 20 --concurrency 4 --rows 5000
+    python load_test.py --server --concurrency 8 --colleges 3 --dedupe --output load.json
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+from benchmark import make_dedup_pair
+
+
+# ========== 请求方式 ==========
+
+class TestClientTransport:
+    """通过Flask测试客户端直接调用应用（不经过网络）"""
+
+    def __init__(self):
+        self.client = main.app.test_client()
+
+    def request(self, method, path, json_data=None, upload=None):
+        if upload is not None:
+            field, file_path = upload
+            with open(file_path, 'rb') as f:
+                response = self.client.open(path, method=method, content_type='multipart/form-data',
+                                            data={field: (f, os.path.basename(file_path))})
+        else:
+            response = self.client.open(path, method=method, json=json_data)
+        return response.status_code, response.get_data()
+
+
+class HttpTransport:
+    """通过HTTP请求本地服务"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, json_data=None, upload=None):
+        headers = {}
+        body = None
+        if upload is not None:
+            field, file_path = upload
+            boundary = uuid.uuid4().hex
+            with open(file_path, 'rb') as f:
+                content = f.read()
+            body = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; '
+                    f'filename="{os.path.basename(file_path)}"\r\n'
+                    'Content-Type: application/octet-stream\r\n\r\n').encode('utf-8') + content + \
+                f'\r\n--{boundary}--\r\n'.encode('utf-8')
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        elif json_data is not None:
+            body = json.dumps(json_data).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        url = self.base_url + urllib.parse.quote(path, safe='/?=&')
+        req = urllib.request.Request(url, data=body, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=600) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+def start_local_server():
+    """在后台线程中启动多线程的本地HTTP服务，返回 (地址, 服务对象)"""
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', server
+
+
+# ========== 会话回放 ==========
+
+class Recorder:
+    """按接口记录每次请求的耗时和是否出错"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.failed_sessions = 0
+
+    def call(self, transport, endpoint, method, path, json_data=None, upload=None):
+        start = time.perf_counter()
+        status, body = transport.request(method, path, json_data, upload)
+        elapsed = time.perf_counter() - start
+
+        result = None
+        failed = status >= 400
+        if body[:1] == b'{':
+            result = json.loads(body)
+            failed = failed or result.get('success') is False
+        with self._lock:
+            self.latencies[endpoint].append(elapsed)
+            if failed:
+                self.errors[endpoint] += 1
+        if failed:
+            raise RuntimeError(f"{endpoint} 失败 ({status}): {body[:200]!r}")
+        return result
+
+
+def run_session(transport, recorder, files, college_count, dedupe, seed):
+    """回放一次完整的使用流程"""
+    main_path, check_path = files
+    main_file = recorder.call(transport, 'POST /upload', 'POST', '/upload', upload=('file', main_path))
+    request_data = {
+        'main_file_path': main_file['file_path'],
+        'college_column': main_file['college_column'],
+        'use_deduplication': dedupe,
+    }
+    if dedupe:
+        check_file = recorder.call(transport, 'POST /upload', 'POST', '/upload', upload=('file', check_path))
+        request_data['check_file_path'] = check_file['file_path']
+
+    stats = recorder.call(transport, 'POST /get-college-statistics', 'POST', '/get-college-statistics',
+                          json_data=request_data)
+    colleges = list(stats['college_stats'])
+    random.Random(seed).shuffle(colleges)
+
+    for college in colleges[:college_count]:
+        result = recorder.call(transport, 'POST /process-college', 'POST', '/process-college',
+                               json_data=dict(request_data, selected_college=college))
+        for filename in (result['college_file'], result['remaining_file']):
+            recorder.call(transport, 'GET /download', 'GET', f"/download/{filename}")
+
+
+# ========== 统计 ==========
+
+def percentile(sorted_values, fraction):
+    """最近秩法求分位数"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(fraction * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for endpoint, latencies in recorder.latencies.items():
+        values = sorted(latencies)
+        endpoints[endpoint] = {
+            'count': len(values),
+            'errors': recorder.errors[endpoint],
+            'mean_ms': round(sum(values) / len(values) * 1000, 2),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+            'throughput_rps': round(len(values) / elapsed, 2) if elapsed else None,
+        }
+    return endpoints
+
+
+def print_report(report):
+    print(f"\n共 {report['sessions']} 个会话，并发 {report['concurrency']}，失败 {report['failed_sessions']}，"
+          f"耗时 {report['elapsed_seconds']:.1f}s，{report['sessions_per_second']:.2f} 会话/秒")
+    print(f"{'接口':<32}{'次数':>7}{'错误':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'吞吐(次/秒)':>14}")
+    for endpoint, stats in report['endpoints'].items():
+        print(f"{endpoint:<32}{stats['count']:>7}{stats['errors']:>6}"
+              f"{stats['p50_ms']:>8.0f}ms{stats['p95_ms']:>8.0f}ms{stats['p99_ms']:>8.0f}ms"
+              f"{stats['throughput_rps']:>14.2f}")
+
+
+def run_load_test(sessions=20, concurrency=4, rows=2000, colleges=2, dedupe=False, file_variants=4,
+                  use_server=False, workdir=None):
+    """生成测试文件后并发回放会话，返回统计结果"""
+    workdir = workdir or tempfile.mkdtemp(prefix='wos_load_test_')
+    data_dir = os.path.join(workdir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    original_cwd = os.getcwd()
+    # 应用的uploads/、outputs/都是相对路径，在临时目录中运行
+    os.chdir(workdir)
+    main.app.root_path = workdir
+    os.makedirs('uploads', exist_ok=True)
+    os.makedirs('outputs', exist_ok=True)
+    server = None
+    try:
+        # 不同会话上传不同内容的文件，避免全部命中同一份上传和结果缓存
+        variants = []
+        for variant in range(file_variants):
+            variant_dir = os.path.join(data_dir, str(variant))
+            os.makedirs(variant_dir, exist_ok=True)
+            variants.append(make_dedup_pair(variant_dir, rows, seed=variant * 100))
+        print(f"已生成 {file_variants} 组 {rows} 行的测试文件", flush=True)
+
+        if use_server:
+            base_url, server = start_local_server()
+
+            def make_transport():
+                return HttpTransport(base_url)
+        else:
+            make_transport = TestClientTransport
+
+        local = threading.local()
+        recorder = Recorder()
+
+        def worker(session_number):
+            if not hasattr(local, 'transport'):
+                local.transport = make_transport()
+            try:
+                run_session(local.transport, recorder, variants[session_number % file_variants], colleges,
+                            dedupe, session_number)
+            except Exception as e:
+                with recorder._lock:
+                    recorder.failed_sessions += 1
+                print(f"会话 {session_number} 失败: {e}", flush=True)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(worker, range(sessions)))
+        elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.shutdown()
+        os.chdir(original_cwd)
+
+    return {
+        'sessions': sessions,
+        'concurrency': concurrency,
+        'rows': rows,
+        'colleges_per_session': colleges,
+        'dedupe': dedupe,
+        'transport': 'http' if use_server else 'test_client',
+        'output_pool_size': main.OUTPUT_POOL_SIZE,
+        'failed_sessions': recorder.failed_sessions,
+        'elapsed_seconds': round(elapsed, 3),
+        'sessions_per_second': round(sessions / elapsed, 3) if elapsed else None,
+        'endpoints': summarize(recorder, elapsed),
+    }
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description='Web接口压力测试')
+    parser.add_argument('--sessions', type=int, default=20, help='回放的会话总数')
+    parser.add_argument('--concurrency', type=int, default=4, help='同时进行的会话数')
+    parser.add_argument('--rows', type=int, default=2000, help='测试文件行数')
+    parser.add_argument('--colleges', type=int, default=2, help='每个会话筛选的学院数')
+    parser.add_argument('--dedupe', action='store_true', help='上传查重文件并查重后筛选')
+    parser.add_argument('--file-variants', type=int, default=4, help='生成几组不同内容的测试文件')
+    parser.add_argument('--server', action='store_true', help='启动本地HTTP服务而不是使用测试客户端')
+    parser.add_argument('--workdir', help='运行目录，默认为临时目录')
+    parser.add_argument('--output', help='结果保存路径（JSON）')
+    args = parser.parse_args(argv)
+
+    main.logger.setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    report = run_load_test(args.sessions, args.concurrency, args.rows, args.colleges, args.dedupe,
+                           args.file_variants, args.server, args.workdir)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.output}")
+    return 1 if report['failed_sessions'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -1,13 +1,51 @@
-from flask import Flask, request, jsonify, send_file, render_template_string
+from flask import Flask, request, jsonify, send_file, render_template_string, Response, stream_with_context, g
 import pandas as pd
+import numpy as np
 import os
-from openpyxl import load_workbook
+import json
+from openpyxl import load_workbook, Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
-from openpyxl.utils import get_column_letter
-from openpyxl.utils.dataframe import dataframe_to_rows
+from openpyxl.utils import get_column_letter, column_index_from_string
+from openpyxl.worksheet.dimensions import ColumnDimension
+from openpyxl.styles.stylesheet import write_stylesheet
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils.datetime import to_excel
+from openpyxl.xml.functions import tostring
+import datetime
+import zipfile
+import struct
+import zlib
+from urllib.parse import quote
+from xml.sax.saxutils import escape, quoteattr
 from copy import copy
-import shutil
+from contextlib import contextmanager
+import functools
+import xml.etree.ElementTree as ET
+from collections import OrderedDict, deque
 import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import time
+import uuid
+import hashlib
+import pickle
+import re
+import sqlite3
+import tracemalloc
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 # 设置日志
 logging.basicConfig(level=logging.DEBUG)
@@ -19,184 +57,811 @@ app = Flask(__name__)
 os.makedirs('uploads', exist_ok=True)
 os.makedirs('outputs', exist_ok=True)
 
+# 上传文件的列式副本（Parquet/Pickle）目录
+SIDECAR_DIR = os.path.join('uploads', '.sidecar')
 
-# ========== 格式复制函数 ==========
+# 上传文件摘要目录（按内容哈希保存）
+UPLOAD_META_DIR = os.path.join('uploads', '.meta')
+
+# 上传文件摘要的格式版本，摘要内容的计算方式变化时递增使旧摘要失效
+UPLOAD_SUMMARY_VERSION = 2
+
+# 处理结果缓存清单
+RESULT_CACHE_PATH = os.path.join('outputs', '.result_cache.json')
+
+# 缓存的处理结果文件占用磁盘上限（MB），超出后删除最久未使用的结果
+RESULT_CACHE_MAX_MB = int(os.environ.get('RESULT_CACHE_MAX_MB', '2048'))
+
+# 尚未下载的处理结果在内存中保留的数据上限（MB），被淘汰后下载时重新筛选
+RESULT_FRAMES_MAX_MB = int(os.environ.get('RESULT_FRAMES_MAX_MB', '512'))
+
+# 结果预览每页最多行数
+PREVIEW_MAX_PAGE_SIZE = 500
+
+# WOS编号索引数据库
+WOS_INDEX_PATH = os.path.join('uploads', '.index', 'wos_index.sqlite3')
+
+# WOS编号索引最多保留的非历史库来源（主文件、查重文件）个数，超出后删除最早登记的
+WOS_INDEX_MAX_SOURCES = int(os.environ.get('WOS_INDEX_MAX_SOURCES', '200'))
+
+# 上传后在后台整表预解析的文件大小上限（MB），更大的文件只扫描WOS列和学院列
+WARM_FULL_MAX_MB = float(os.environ.get('WARM_FULL_MAX_MB', '20'))
+
+# 已解析DataFrame缓存的内存上限（MB）
+DATAFRAME_CACHE_MAX_MB = int(os.environ.get('DATAFRAME_CACHE_MAX_MB', '1024'))
+
+# 缓存的模板格式数量
+TEMPLATE_PROFILE_CACHE_SIZE = 64
+
+# 生成输出文件的进程数，0表示在当前进程中串行生成
+OUTPUT_POOL_SIZE = int(os.environ.get('OUTPUT_POOL_SIZE', str(os.cpu_count() or 1)))
+
+# 缓存的学院索引个数（每个文件的每个学院列一个）
+COLLEGE_INDEX_CACHE_SIZE = 64
+
+# 进度事件流无事件时发送保活注释的间隔（秒）
+SSE_KEEPALIVE_SECONDS = 15
+
+# 同时执行的后台任务数，超出的任务排队等待
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+
+# 已结束的后台任务保留时间（秒）
+JOB_RETENTION_SECONDS = 3600
+
+# 筛选会话空闲多久后释放（秒）
+SESSION_IDLE_SECONDS = int(os.environ.get('SESSION_IDLE_SECONDS', '1800'))
+
+# 单个筛选会话的数据占用上限（MB），超出时不建立会话，继续按文件筛选
+SESSION_MAX_MB = int(os.environ.get('SESSION_MAX_MB', '512'))
+
+# 是否允许通过请求头 X-Debug-Trace: 1 或参数 debug_trace=1 追踪单个请求（默认关闭）
+DEBUG_TRACE_ENABLED = os.environ.get('DEBUG_TRACE_ENABLED', '0') == '1'
+
+# 请求追踪记录（JSONL）
+TRACE_LOG_PATH = os.environ.get('TRACE_LOG_PATH', os.path.join('uploads', '.traces', 'traces.jsonl'))
+
+# /debug/traces 显示的最近追踪记录数
+TRACE_HISTORY_SIZE = 100
+
+# 超过该大小（MB）的xlsx输入文件分批读取处理，峰值内存只与批大小有关；0表示不分批
+CHUNKED_MIN_MB = float(os.environ.get('CHUNKED_MIN_MB', '100'))
+
+# 分批处理时每批读取的行数
+CHUNK_ROWS = int(os.environ.get('CHUNK_ROWS', '20000'))
+
+# 耗时直方图的桶上限（秒）
+METRIC_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+# ========== 性能指标 ==========
+
+_metrics = OrderedDict()
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class _Metric:
+    """按标签值分别累计的指标，输出子进程中记录的值通过队列转交主进程"""
+
+    metric_type = None
 
-def copy_cell_style(source_cell, target_cell):
-    """复制单元格样式"""
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics[name] = self
+
+    def record(self, value, labels):
+        if _worker_progress_queue is not None:
+            _worker_progress_queue.put(('metric', self.name, value, labels))
+            return
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self._lock:
+            self._record_locked(key, value)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.metric_type}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self.record(amount, labels)
+
+    def _record_locked(self, key, value):
+        self._values[key] = self._values.get(key, 0) + value
+
+    def _render_value(self, key, value):
+        yield f'{self.name}{_format_labels(self.label_names, key)} {value}'
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=METRIC_DURATION_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        self.record(value, labels)
+
+    def _record_locked(self, key, value):
+        # [各桶计数, 总和, 次数]，桶计数在输出时累加
+        state = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+        bucket = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        state[0][bucket] += 1
+        state[1] += value
+        state[2] += 1
+
+    def _render_value(self, key, value):
+        bucket_counts, total, count = value
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), bucket_counts):
+            cumulative += bucket_count
+            yield f'{self.name}_bucket{_format_labels(self.label_names, key, [("le", bound)])} {cumulative}'
+        yield f'{self.name}_sum{_format_labels(self.label_names, key)} {total}'
+        yield f'{self.name}_count{_format_labels(self.label_names, key)} {count}'
+
+
+_stage_duration = Histogram(
+    'wos_stage_duration_seconds',
+    '各处理阶段耗时（read/dedupe/filter/serial_reset/template_load/row_write/save）', ['stage'])
+_http_request_duration = Histogram(
+    'wos_http_request_duration_seconds', '接口处理耗时（不含流式响应体的传输）', ['endpoint', 'method'])
+_http_requests = Counter('wos_http_requests_total', '接口请求数', ['endpoint', 'method', 'status'])
+_rows_processed = Counter('wos_rows_processed_total', '各阶段处理的记录数', ['stage'])
+_cache_hits = Counter('wos_cache_hits_total', '缓存命中次数', ['cache'])
+_cache_misses = Counter('wos_cache_misses_total', '缓存未命中次数', ['cache'])
+_bytes_written = Counter('wos_output_bytes_written_total', '生成的Excel文件字节数（file为写入磁盘，stream为流式输出）',
+                         ['mode'])
+
+
+@contextmanager
+def timed_stage(stage, **attrs):
+    """记录代码块耗时到指定处理阶段，追踪请求时同时记录为追踪区段"""
+    start = time.perf_counter()
     try:
-        # 复制字体
-        if source_cell.font:
-            target_cell.font = copy(source_cell.font)
+        with trace_span(stage, **attrs):
+            yield
+    finally:
+        _stage_duration.observe(time.perf_counter() - start, stage=stage)
 
-        # 复制填充
-        if source_cell.fill and source_cell.fill.fill_type:
-            target_cell.fill = copy(source_cell.fill)
 
-        # 复制边框
-        if source_cell.border:
-            target_cell.border = copy(source_cell.border)
+def timed(stage):
+    """记录函数耗时到指定处理阶段的装饰器"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed_stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
-        # 复制对齐
-        if source_cell.alignment:
-            target_cell.alignment = copy(source_cell.alignment)
 
-        # 复制数字格式
-        if source_cell.number_format:
-            target_cell.number_format = source_cell.number_format
+def record_cache_lookup(cache, hit):
+    """记录一次缓存查找结果"""
+    (_cache_hits if hit else _cache_misses).inc(cache=cache)
+
+
+def render_metrics():
+    """以Prometheus文本格式输出所有指标"""
+    lines = []
+    for metric in _metrics.values():
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
 
-    except Exception as e:
-        logger.error(f"复制单元格样式时出错: {e}")
 
+# ========== 请求追踪 ==========
 
-def copy_worksheet_formatting(source_ws, target_ws):
-    """复制工作表的格式设置"""
+_trace_context = threading.local()
+_recent_traces = deque(maxlen=TRACE_HISTORY_SIZE)
+_traces_lock = threading.Lock()
+_tracemalloc_users = 0
+# tracemalloc是否由请求追踪启动，其他代码已启动的不在追踪结束时停止
+_tracemalloc_started = False
+
+
+def _current_rss():
+    """当前进程的常驻内存（字节），无法获取时返回None"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
     try:
-        # 复制列宽
-        for col_idx in range(1, source_ws.max_column + 1):
-            col_letter = get_column_letter(col_idx)
-            source_dim = source_ws.column_dimensions[col_letter]
-            if source_dim.width is not None:
-                target_ws.column_dimensions[col_letter].width = source_dim.width
-
-        # 复制行高
-        for row_idx in range(1, min(source_ws.max_row, target_ws.max_row) + 1):
-            source_dim = source_ws.row_dimensions[row_idx]
-            if source_dim.height is not None:
-                target_ws.row_dimensions[row_idx].height = source_dim.height
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _to_mb(size):
+    return round(size / (1024 * 1024), 3) if size is not None else None
+
+
+def trace_active():
+    """当前线程是否正在追踪请求"""
+    return bool(getattr(_trace_context, 'stack', None))
+
+
+def _open_span(name, attrs):
+    stack = _trace_context.stack
+    current, peak = tracemalloc.get_traced_memory()
+    # 峰值计数是全局的，重置前先计入外层各区段
+    for frame in stack:
+        frame['peak'] = max(frame['peak'], peak)
+    tracemalloc.reset_peak()
+    span = {'name': name, 'attrs': attrs, 'children': []}
+    if stack:
+        stack[-1]['span']['children'].append(span)
+    stack.append({'span': span, 'start': time.perf_counter(), 'memory': current, 'peak': current,
+                  'rss': _current_rss()})
+    return span
+
+
+def _close_span():
+    frame = _trace_context.stack.pop()
+    current, peak = tracemalloc.get_traced_memory()
+    rss = _current_rss()
+    span = frame['span']
+    span['start_ms'] = round((frame['start'] - _trace_context.started) * 1000, 3)
+    span['duration_ms'] = round((time.perf_counter() - frame['start']) * 1000, 3)
+    span['peak_mb'] = _to_mb(max(frame['peak'], peak) - frame['memory'])
+    span['memory_delta_mb'] = _to_mb(current - frame['memory'])
+    span['rss_delta_mb'] = _to_mb(rss - frame['rss']) if rss is not None and frame['rss'] is not None else None
+    return span
+
+
+@contextmanager
+def trace_span(name, **attrs):
+    """在当前请求的追踪中记录一个区段，未追踪时不做任何事"""
+    if not trace_active():
+        yield
+        return
+    _open_span(name, attrs)
+    try:
+        yield
+    finally:
+        _close_span()
+
+
+def traced(name):
+    """把函数调用记录为追踪区段的装饰器"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_trace(method, path):
+    """开始追踪当前线程处理的请求，返回追踪编号"""
+    global _tracemalloc_users, _tracemalloc_started
+    with _traces_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracemalloc_started = True
+        _tracemalloc_users += 1
+    trace_id = uuid.uuid4().hex[:16]
+    _trace_context.trace_id = trace_id
+    _trace_context.started = time.perf_counter()
+    _trace_context.started_at = time.time()
+    _trace_context.stack = []
+    _open_span(f'{method} {path}', {})
+    return trace_id
+
+
+def finish_trace(status):
+    """结束当前线程的追踪，记录到内存和JSONL文件，返回追踪记录"""
+    global _tracemalloc_users, _tracemalloc_started
+    root = None
+    while _trace_context.stack:
+        root = _close_span()
+    _trace_context.stack = None
+
+    trace = {
+        'trace_id': _trace_context.trace_id,
+        'started_at': datetime.datetime.fromtimestamp(_trace_context.started_at).isoformat(timespec='milliseconds'),
+        'name': root['name'],
+        'status': status,
+        'duration_ms': root['duration_ms'],
+        'peak_mb': root['peak_mb'],
+        'rss_delta_mb': root['rss_delta_mb'],
+        'root': root,
+    }
+    with _traces_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0 and _tracemalloc_started:
+            tracemalloc.stop()
+            _tracemalloc_started = False
+        _recent_traces.append(trace)
+        try:
+            os.makedirs(os.path.dirname(TRACE_LOG_PATH), exist_ok=True)
+            with open(TRACE_LOG_PATH, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(trace, ensure_ascii=False, default=str) + '\n')
+        except Exception as e:
+            logger.error(f"写入请求追踪记录时出错: {e}")
+    return trace
+
+
+def recent_traces():
+    """最近的追踪记录，最新的在前"""
+    with _traces_lock:
+        return list(reversed(_recent_traces))
+
+
+def flatten_spans(span, depth=0):
+    """按先后顺序展开区段树，返回 (层级, 区段) 列表"""
+    rows = [(depth, span)]
+    for child in span['children']:
+        rows.extend(flatten_spans(child, depth + 1))
+    return rows
+
+
+# ========== 数据读取缓存 ==========
+
+class SizedLRUCache:
+    """按容量限制的线程安全LRU缓存，sizeof决定每个对象占用的容量（如字节数）"""
+
+    def __init__(self, max_size, sizeof):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self._items = OrderedDict()
+        self._total_size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self._total_size -= self._items.pop(key)[1]
+            if size > self.max_size:
+                # 单个对象超过上限时不缓存
+                return
+            self._items[key] = (value, size)
+            self._total_size += size
+            while self._total_size > self.max_size:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._total_size -= evicted_size
+
+    def find(self, predicate):
+        """返回第一个键满足条件的对象，没有时返回None"""
+        with self._lock:
+            for key, (value, _) in self._items.items():
+                if predicate(key):
+                    self._items.move_to_end(key)
+                    return value
+        return None
+
+    def discard_where(self, predicate):
+        """删除满足条件的所有键"""
+        with self._lock:
+            for key in [k for k in self._items if predicate(k)]:
+                self._total_size -= self._items.pop(key)[1]
+
+
+class KeyedLocks:
+    """按键分配的互斥锁，同一键的调用依次执行；无人持有或等待时删除该键的锁"""
+
+    def __init__(self):
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    @contextmanager
+    def hold(self, key):
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+def get_file_signature(file_path):
+    """生成文件签名（绝对路径、大小、修改时间）"""
+    stat = os.stat(file_path)
+    return os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns
+
+
+def _dataframe_nbytes(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+_dataframe_cache = SizedLRUCache(DATAFRAME_CACHE_MAX_MB * 1024 * 1024, _dataframe_nbytes)
+_dataframe_load_locks = KeyedLocks()
+
 
+def _sidecar_base(signature):
+    """列式副本路径（不含扩展名），文件名中带源文件大小和修改时间"""
+    abs_path, size, mtime_ns = signature
+    return os.path.join(SIDECAR_DIR, f"{os.path.basename(abs_path)}.{size}-{mtime_ns}")
+
+
+def _project_columns(df, columns):
+    """按列名投影，不存在的列忽略"""
+    return df[[col for col in columns if col in df.columns]]
+
+
+@traced('read_sidecar')
+def read_sidecar(signature, columns=None):
+    """读取与源文件签名匹配的列式副本，不存在时返回None
+
+    columns指定时只读取这些列，Parquet副本只解码所需的列。
+    """
+    base = _sidecar_base(signature)
+    try:
+        if os.path.exists(base + '.parquet'):
+            if columns is None:
+                return pd.read_parquet(base + '.parquet')
+            names = pyarrow.parquet.read_schema(base + '.parquet').names
+            return pd.read_parquet(base + '.parquet', columns=[col for col in columns if col in names])
+        if os.path.exists(base + '.pkl'):
+            df = pd.read_pickle(base + '.pkl')
+            return df if columns is None else _project_columns(df, columns)
     except Exception as e:
-        logger.error(f"复制工作表格式时出错: {e}")
+        logger.error(f"读取列式副本时出错: {e}")
+    return None
 
 
-def create_exact_copy_from_template(template_file, data_df, output_file):
-    """基于模板创建精确格式副本"""
+@traced('write_sidecar')
+def write_sidecar(signature, df):
+    """写入列式副本，并删除同一源文件的旧副本"""
     try:
-        # 复制模板文件
-        shutil.copy2(template_file, output_file)
-        wb = load_workbook(output_file)
-        ws = wb.active
+        os.makedirs(SIDECAR_DIR, exist_ok=True)
+        base = _sidecar_base(signature)
+        prefix = os.path.basename(signature[0]) + '.'
+        for name in os.listdir(SIDECAR_DIR):
+            if name.startswith(prefix) and not name.startswith(os.path.basename(base) + '.'):
+                os.remove(os.path.join(SIDECAR_DIR, name))
+
+        tmp_path = f"{base}.{threading.get_ident()}.tmp"
+        if pyarrow is not None:
+            try:
+                df.to_parquet(tmp_path, index=False)
+                os.replace(tmp_path, base + '.parquet')
+                return
+            except Exception as e:
+                # 混合类型列等无法写成Parquet时退回Pickle
+                logger.debug(f"无法写入Parquet副本，改用Pickle: {e}")
+        df.to_pickle(tmp_path)
+        os.replace(tmp_path, base + '.pkl')
+    except Exception as e:
+        logger.error(f"写入列式副本时出错: {e}")
+
+
+@timed('read')
+def read_excel_cached(file_path, columns=None):
+    """读取Excel文件，同一文件（路径、大小、修改时间不变）只解析一次
+
+    依次查找内存缓存、磁盘上的列式副本，都没有时才解析Excel并写入副本。
+    columns指定时只读取这些列（不存在的列忽略），用于统计、查重等
+    不需要生成输出文件的场景；此时不会为了写副本而读取整张表，
+    xlsx文件以只读模式逐行扫描，只转换所需列的单元格。
+    返回的DataFrame在多个请求间共享，调用方不得原地修改。
+    """
+    signature = get_file_signature(file_path)
+    columns = tuple(columns) if columns is not None else None
+    if columns is not None:
+        # 已有完整数据或包含所需各列的部分数据时直接投影
+        wanted = set(columns)
+        cached_df = _dataframe_cache.find(
+            lambda key: key[0] == signature and (key[1] is None or wanted.issubset(key[1])))
+        if cached_df is not None:
+            logger.debug(f"命中数据缓存: {file_path}")
+            record_cache_lookup('dataframe', True)
+            _rows_processed.inc(len(cached_df), stage='read')
+            return _project_columns(cached_df, columns)
+
+    cache_key = (signature, columns)
+    df = _dataframe_cache.get(cache_key)
+    if df is not None:
+        logger.debug(f"命中数据缓存: {file_path}")
+        record_cache_lookup('dataframe', True)
+        _rows_processed.inc(len(df), stage='read')
+        return df
+
+    # 同一文件并发请求时只解析一次
+    rows_counted = False
+    with _dataframe_load_locks.hold(cache_key):
+        df = _dataframe_cache.get(cache_key)
+        record_cache_lookup('dataframe', df is not None)
+        if df is None:
+            df = read_sidecar(signature, columns)
+            record_cache_lookup('sidecar', df is not None)
+            if df is not None:
+                logger.debug(f"读取列式副本: {file_path}")
+            elif columns is None:
+                logger.debug(f"解析Excel文件: {file_path}")
+                with trace_span('pd.read_excel', file=os.path.basename(file_path)):
+                    df = pd.read_excel(file_path)
+                write_sidecar(signature, df)
+            elif file_path.endswith('.xlsx'):
+                # read_excel即使指定usecols也会转换每个单元格，只读扫描只转换所需的列
+                logger.debug(f"扫描Excel文件的部分列: {file_path} {list(columns)}")
+                with trace_span('read_columns', file=os.path.basename(file_path), columns=list(columns)):
+                    df = read_excel_columns(file_path, columns)
+                rows_counted = True
+            else:
+                logger.debug(f"解析Excel文件的部分列: {file_path} {list(columns)}")
+                with trace_span('pd.read_excel', file=os.path.basename(file_path), columns=list(columns)):
+                    df = pd.read_excel(file_path, usecols=lambda col: col in wanted)
+            # 同一路径的旧版本已失效
+            _dataframe_cache.discard_where(lambda key: key[0][0] == signature[0] and key[0] != signature)
+            _dataframe_cache.put(cache_key, df)
+    if not rows_counted:
+        _rows_processed.inc(len(df), stage='read')
+    return df
+
+
+_sidecar_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sidecar')
+
+
+def warm_dataframe_cache(file_path, columns=None):
+    """在后台解析上传的文件，columns为None时读取整表并写入列式副本，否则只读取这些列"""
+    try:
+        read_excel_cached(file_path, columns)
+    except Exception as e:
+        logger.error(f"预先解析文件时出错: {file_path}: {e}")
 
-        # 清除现有数据（保留标题行）
-        if ws.max_row > 1:
-            ws.delete_rows(2, ws.max_row - 1)
-
-        # 复制标题行样式（保持加粗）
-        if ws.max_row >= 1:
-            for col_idx in range(1, min(len(ws[1]), len(data_df.columns)) + 1):
-                source_cell = ws.cell(row=1, column=col_idx)
-                target_cell = ws.cell(row=1, column=col_idx)
-                copy_cell_style(source_cell, target_cell)
-
-        # 获取数据行样式模板（使用第二行作为数据行样式模板）
-        template_data_row = 2 if ws.max_row >= 2 else 1
-
-        # 写入数据
-        for row_idx, row_data in enumerate(dataframe_to_rows(data_df, index=False, header=False), 2):
-            for col_idx, cell_value in enumerate(row_data, 1):
-                if col_idx > len(data_df.columns):
-                    continue
-
-                target_cell = ws.cell(row=row_idx, column=col_idx)
-                target_cell.value = cell_value
-
-                # 应用样式，但确保数据行不加粗
-                if template_data_row <= ws.max_row:
-                    source_cell = ws.cell(row=template_data_row, column=col_idx)
-                    copy_cell_style(source_cell, target_cell)
-
-                    # 确保数据行字体不加粗
-                    if target_cell.font:
-                        target_cell.font = Font(
-                            name=target_cell.font.name,
-                            size=target_cell.font.size,
-                            bold=False,  # 数据行强制不加粗
-                            italic=target_cell.font.italic,
-                            underline=target_cell.font.underline,
-                            color=target_cell.font.color
-                        )
-                else:
-                    # 如果没有数据行模板，使用标题行样式但取消加粗
-                    source_cell = ws.cell(row=1, column=col_idx)
-                    copy_cell_style(source_cell, target_cell)
-                    if target_cell.font:
-                        target_cell.font = Font(
-                            name=target_cell.font.name,
-                            size=target_cell.font.size,
-                            bold=False,  # 数据行不加粗
-                            italic=target_cell.font.italic,
-                            underline=target_cell.font.underline,
-                            color=target_cell.font.color
-                        )
-
-        # 删除多余行
-        if ws.max_row > len(data_df) + 1:
-            ws.delete_rows(len(data_df) + 2, ws.max_row - len(data_df) - 1)
 
-        wb.save(output_file)
-        logger.info(f"成功创建格式化的文件: {output_file}")
-        return True
+# ========== 格式复制函数 ==========
 
-    except Exception as e:
-        logger.error(f"创建精确副本时出错: {str(e)}")
-        # 如果模板方法失败，使用简单方法
-        logger.info("尝试使用简单方法创建Excel文件")
-        return create_simple_excel(data_df, output_file)
+def _extract_cell_style(cell, bold=None):
+    """提取单元格样式，bold不为None时覆盖加粗属性"""
+    font = copy(cell.font) if cell.font else Font()
+    if bold is not None:
+        font.bold = bold
+    return {
+        'font': font,
+        'fill': copy(cell.fill) if cell.fill and cell.fill.fill_type else None,
+        'border': copy(cell.border) if cell.border else None,
+        'alignment': copy(cell.alignment) if cell.alignment else None,
+        'number_format': cell.number_format,
+    }
 
 
-def copy_cell_style(source_cell, target_cell):
-    """复制单元格样式，但允许单独控制加粗属性"""
+_SHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+
+def _load_sheet_dimensions(template_file):
+    """完整加载模板，读取列宽和标题行高"""
+    wb = load_workbook(template_file)
     try:
-        # 复制字体（除了加粗属性）
-        if source_cell.font:
-            target_cell.font = Font(
-                name=source_cell.font.name,
-                size=source_cell.font.size,
-                bold=source_cell.font.bold,  # 这个属性会在调用函数中单独控制
-                italic=source_cell.font.italic,
-                underline=source_cell.font.underline,
-                color=source_cell.font.color
-            )
+        ws = wb.active
+        column_widths = []
+        for key, dim in ws.column_dimensions.items():
+            if dim.width:
+                min_col = dim.min or column_index_from_string(key)
+                column_widths.append((min_col, dim.max or min_col, float(dim.width)))
+        header_height = ws.row_dimensions[1].height if 1 in ws.row_dimensions else None
+        return sorted(column_widths), header_height
+    finally:
+        wb.close()
+
+
+def _read_sheet_dimensions(ws, template_file):
+    """从工作表XML头部读取列宽和标题行高，读到第一行即停止
+
+    只读模式的工作表不提供列宽和行高，这里借用openpyxl的内部接口读取原始XML；
+    该接口不可用时退回完整加载模板。
+    """
+    try:
+        source = ws._get_source()
+    except Exception as e:
+        logger.warning(f"无法直接读取工作表XML，完整加载模板读取列宽: {e}")
+        return _load_sheet_dimensions(template_file)
+
+    column_widths = []
+    header_height = None
+    with source:
+        for event, element in ET.iterparse(source, events=('start', 'end')):
+            if event == 'end' and element.tag == _SHEET_NS + 'col':
+                width = element.get('width')
+                if width is not None and element.get('customWidth') in ('1', 'true'):
+                    min_col = int(element.get('min'))
+                    max_col = int(element.get('max', min_col))
+                    column_widths.append((min_col, max_col, float(width)))
+            elif event == 'start' and element.tag == _SHEET_NS + 'row':
+                if element.get('r', '1') == '1' and element.get('ht') is not None:
+                    header_height = float(element.get('ht'))
+                break
+            elif event == 'end' and element.tag == _SHEET_NS + 'sheetData':
+                break
+    return column_widths, header_height
+
+
+def read_template_profile(template_file):
+    """以只读模式读取模板的标题行、首个数据行样式以及列宽和标题行高"""
+    wb = load_workbook(template_file, read_only=True)
+    try:
+        ws = wb.active
+        rows = list(ws.iter_rows(min_row=1, max_row=2))
+        header_cells = list(rows[0]) if rows else []
+        data_cells = list(rows[1]) if len(rows) > 1 else []
+
+        header_styles = [_extract_cell_style(cell) for cell in header_cells]
+        data_styles = []
+        for col_idx, header_cell in enumerate(header_cells):
+            # 没有数据行模板时使用标题行样式，数据行一律不加粗
+            source_cell = data_cells[col_idx] if col_idx < len(data_cells) else header_cell
+            data_styles.append(_extract_cell_style(source_cell, bold=False))
+
+        # 列宽以 (起始列, 结束列, 宽度) 记录
+        column_widths, header_height = _read_sheet_dimensions(ws, template_file)
+
+        return {
+            'title': ws.title,
+            'header_values': [cell.value for cell in header_cells],
+            'header_styles': header_styles,
+            'data_styles': data_styles,
+            'column_widths': column_widths,
+            'header_height': header_height,
+        }
+    finally:
+        wb.close()
 
-        # 复制填充
-        if source_cell.fill and source_cell.fill.fill_type:
-            target_cell.fill = copy(source_cell.fill)
 
-        # 复制边框
-        if source_cell.border:
-            target_cell.border = copy(source_cell.border)
+_template_profile_cache = SizedLRUCache(TEMPLATE_PROFILE_CACHE_SIZE, lambda profile: 1)
 
-        # 复制对齐
-        if source_cell.alignment:
-            target_cell.alignment = copy(source_cell.alignment)
 
-        # 复制数字格式
-        if source_cell.number_format:
-            target_cell.number_format = source_cell.number_format
+@timed('template_load')
+def get_template_profile(template_file):
+    """获取模板格式，同一模板文件只读取一次"""
+    signature = get_file_signature(template_file)
+    profile = _template_profile_cache.get(signature)
+    record_cache_lookup('template_profile', profile is not None)
+    if profile is None:
+        profile = read_template_profile(template_file)
+        _template_profile_cache.put(signature, profile)
+    else:
+        logger.debug(f"命中模板格式缓存: {template_file}")
+    return profile
+
+
+def _styled_write_only_cell(ws, style):
+    """创建带样式的只写单元格，每列只解析一次样式"""
+    return _apply_cell_style(WriteOnlyCell(ws), style)
+
+
+def _apply_cell_style(cell, style):
+    if style is None:
+        return cell
+    cell.font = style['font']
+    if style['fill'] is not None:
+        cell.fill = style['fill']
+    if style['border'] is not None:
+        cell.border = style['border']
+    if style['alignment'] is not None:
+        cell.alignment = style['alignment']
+    if style['number_format']:
+        cell.number_format = style['number_format']
+    return cell
+
+
+def _to_excel_value(value):
+    """把pandas缺失值转换为空单元格"""
+    if value is None:
+        return None
+    try:
+        if pd.isna(value):
+            return None
+    except (TypeError, ValueError):
+        pass
+    return value
 
-    except Exception as e:
-        logger.error(f"复制单元格样式时出错: {e}")
 
+class TemplateSheetWriter:
+    """按模板格式以只写模式逐批追加数据行，已写出的行不占用内存"""
 
-def ensure_no_bold_in_data_rows(worksheet, data_df):
-    """确保所有数据行字体不加粗"""
+    def __init__(self, profile, column_count):
+        self.wb = Workbook(write_only=True)
+        ws = self.ws = self.wb.create_sheet(profile['title'])
+
+        # 列宽和标题行高必须在写入数据前设置
+        for min_col, max_col, width in profile['column_widths']:
+            col_letter = get_column_letter(min_col)
+            ws.column_dimensions[col_letter] = ColumnDimension(
+                ws, index=col_letter, min=min_col, max=max_col, width=width, customWidth=True
+            )
+        if profile['header_height'] is not None:
+            ws.row_dimensions[1].height = profile['header_height']
+
+        # 标题行沿用模板（保持加粗）
+        header_row = []
+        for value, style in zip(profile['header_values'], profile['header_styles']):
+            cell = _styled_write_only_cell(ws, style)
+            cell.value = value
+            header_row.append(cell)
+        ws.append(header_row)
+
+        # 数据行：每列一个带样式的单元格，逐行复用
+        data_styles = profile['data_styles']
+        self.row_cells = [
+            _styled_write_only_cell(ws, data_styles[col_idx] if col_idx < len(data_styles) else None)
+            for col_idx in range(column_count)
+        ]
+        self.rows_written = 0
+        self.closed = False
+
+    def discard(self):
+        """放弃尚未保存的文件，删除只写工作表已写出行的临时文件"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.ws.close()
+            self.ws._writer.cleanup()
+        except Exception as e:
+            logger.error(f"清理只写工作表临时文件时出错: {e}")
+
+    def append(self, data_df, on_progress=None):
+        """追加一批数据行，每写出ROWS_PROGRESS_INTERVAL行调用一次on_progress(已写行数)"""
+        for row_data in data_df.itertuples(index=False, name=None):
+            for cell, cell_value in zip(self.row_cells, row_data):
+                cell.value = _to_excel_value(cell_value)
+            self.ws.append(self.row_cells)
+            self.rows_written += 1
+            if on_progress is not None and self.rows_written % ROWS_PROGRESS_INTERVAL == 0:
+                on_progress(self.rows_written)
+
+    def save(self, output_file):
+        self.closed = True
+        with timed_stage('save', file=os.path.basename(output_file)):
+            self.wb.save(output_file)
+        _rows_processed.inc(self.rows_written, stage='write')
+        _bytes_written.inc(os.path.getsize(output_file), mode='file')
+
+
+def create_exact_copy_from_template(template_file, data_df, output_file, profile=None, job_id=None):
+    """基于模板创建精确格式副本
+
+    只读取模板的标题行和第一行数据样式，数据以只写模式逐行写出，
+    每列的样式只解析一次，无需加载整个模板工作簿。
+    已读取的模板格式可通过profile传入，指定job_id时向该任务报告写出行数。
+    """
     try:
-        for row in range(2, worksheet.max_row + 1):
-            for col in range(1, len(data_df.columns) + 1):
-                cell = worksheet.cell(row=row, column=col)
-                if cell.font:
-                    # 创建新的字体对象，确保不加粗
-                    new_font = Font(
-                        name=cell.font.name,
-                        size=cell.font.size,
-                        bold=False,  # 强制不加粗
-                        italic=cell.font.italic,
-                        underline=cell.font.underline,
-                        color=cell.font.color
-                    )
-                    cell.font = new_font
+        if profile is None:
+            profile = get_template_profile(template_file)
+
+        writer = TemplateSheetWriter(profile, len(data_df.columns))
+        total_rows = len(data_df)
+        with timed_stage('row_write', rows=total_rows):
+            writer.append(data_df, lambda rows_written: report_rows_written(job_id, output_file, rows_written,
+                                                                            total_rows))
+        writer.save(output_file)
+        report_rows_written(job_id, output_file, total_rows, total_rows)
+        logger.info(f"成功创建格式化的文件: {output_file}")
+        return True
+
     except Exception as e:
-        logger.error(f"确保不加粗时出错: {str(e)}")
+        logger.error(f"创建精确副本时出错: {str(e)}")
+        # 如果模板方法失败，使用简单方法
+        logger.info("尝试使用简单方法创建Excel文件")
+        return create_simple_excel(data_df, output_file)
 
 
 def create_simple_excel(data_df, output_file):
@@ -245,31 +910,731 @@ def create_simple_excel(data_df, output_file):
         logger.error(f"创建简单Excel时出错: {str(e)}")
         return False
 
+# ========== 流式生成Excel ==========
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# 流式生成时每写出多少行向响应输出一次
+STREAM_FLUSH_ROWS = 1000
+
+# 单元格数超过该值时工作表条目使用ZIP64（流式写出时无法事先知道条目大小）
+STREAM_ZIP64_CELLS = 20000000
+
+# 与openpyxl一致：日期时间单元格没有数字格式时使用的默认格式
+_DATE_FORMATS = {
+    datetime.datetime: 'yyyy-mm-dd h:mm:ss',
+    datetime.date: 'yyyy-mm-dd',
+    datetime.time: 'h:mm:ss',
+}
+
+_XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '</Types>'
+)
+
+_XLSX_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+_XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/>'
+    '</Relationships>'
+)
+
+
+class _StreamSink:
+    """收集zip写出的字节，由生成器分批取走（不可寻址，zipfile会写数据描述符）"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        _bytes_written.inc(len(data), mode='stream')
+        return data
+
+
+def _stream_cell_xml(ref, style_id, value):
+    """生成单个单元格的XML，字符串以内联字符串写出"""
+    style_attr = f' s="{style_id}"' if style_id else ''
+    if value is None:
+        return f'<c r="{ref}"{style_attr}/>'
+    if pd.api.types.is_bool(value):
+        return f'<c r="{ref}"{style_attr} t="b"><v>{int(value)}</v></c>'
+    if pd.api.types.is_integer(value):
+        return f'<c r="{ref}"{style_attr}><v>{int(value)}</v></c>'
+    if pd.api.types.is_float(value):
+        # 无穷大等非有限数值与缺失值一样写成空单元格
+        if not np.isfinite(value):
+            return f'<c r="{ref}"{style_attr}/>'
+        return f'<c r="{ref}"{style_attr}><v>{float(value)!r}</v></c>'
+    text = escape(ILLEGAL_CHARACTERS_RE.sub('', str(value)))
+    return f'<c r="{ref}"{style_attr} t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def stream_xlsx_from_template(template_file, data_df, profile=None):
+    """按模板格式生成Excel文件并逐块返回字节，不写临时文件
+
+    工作表XML随数据逐行生成并直接压缩输出，内存占用与数据行数无关；
+    样式表在最后写出，因此日期单元格的格式可以在写出过程中登记。
+    """
+    if profile is None:
+        profile = get_template_profile(template_file)
+
+    # 借用openpyxl的工作簿登记样式，最后由它生成styles.xml
+    style_wb = Workbook()
+    style_ws = style_wb.active
+    style_ids = {}
+
+    def style_id_for(style, number_format=None):
+        key = (id(style), number_format)
+        if key not in style_ids:
+            cell = _apply_cell_style(style_ws.cell(row=len(style_ids) + 1, column=1), style)
+            if number_format:
+                cell.number_format = number_format
+            style_ids[key] = cell.style_id
+        return style_ids[key]
+
+    sink = _StreamSink()
+    zf = zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED)
+    zf.writestr('[Content_Types].xml', _XLSX_CONTENT_TYPES)
+    zf.writestr('_rels/.rels', _XLSX_ROOT_RELS)
+    zf.writestr('xl/_rels/workbook.xml.rels', _XLSX_WORKBOOK_RELS)
+    zf.writestr('xl/workbook.xml', (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        f'<sheets><sheet name={quoteattr(profile["title"])} sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ))
+    yield sink.drain()
+
+    column_count = len(data_df.columns)
+    header_styles = profile['header_styles']
+    data_styles = profile['data_styles']
+    letters = [get_column_letter(col_idx) for col_idx in range(1, max(column_count, len(header_styles)) + 1)]
+    column_styles = [data_styles[col_idx] if col_idx < len(data_styles) else None for col_idx in range(column_count)]
+    data_style_ids = [style_id_for(style) if style else 0 for style in column_styles]
+
+    force_zip64 = (len(data_df) + 1) * max(column_count, 1) > STREAM_ZIP64_CELLS
+    with zf.open('xl/worksheets/sheet1.xml', 'w', force_zip64=force_zip64) as sheet:
+        parts = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                 '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">']
+        if profile['column_widths']:
+            parts.append('<cols>')
+            for min_col, max_col, width in profile['column_widths']:
+                parts.append(f'<col min="{min_col}" max="{max_col}" width="{width}" customWidth="1"/>')
+            parts.append('</cols>')
+        parts.append('<sheetData>')
+
+        # 标题行沿用模板（保持加粗）
+        height = profile['header_height']
+        row_attrs = f' ht="{height}" customHeight="1"' if height is not None else ''
+        parts.append(f'<row r="1"{row_attrs}>')
+        for col_idx, (value, style) in enumerate(zip(profile['header_values'], header_styles)):
+            parts.append(_stream_cell_xml(f'{letters[col_idx]}1', style_id_for(style), value))
+        parts.append('</row>')
+
+        for row_number, row_data in enumerate(data_df.itertuples(index=False, name=None), 2):
+            parts.append(f'<row r="{row_number}">')
+            for col_idx, cell_value in enumerate(row_data):
+                value = _to_excel_value(cell_value)
+                style_id = data_style_ids[col_idx]
+                if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+                    style = column_styles[col_idx]
+                    if style is None or style['number_format'] in (None, 'General'):
+                        date_type = next(t for t in _DATE_FORMATS if isinstance(value, t))
+                        style_id = style_id_for(style, _DATE_FORMATS[date_type])
+                    value = to_excel(value)
+                parts.append(_stream_cell_xml(f'{letters[col_idx]}{row_number}', style_id, value))
+            parts.append('</row>')
+            if row_number % STREAM_FLUSH_ROWS == 0:
+                sheet.write(''.join(parts).encode('utf-8'))
+                parts = []
+                chunk = sink.drain()
+                if chunk:
+                    yield chunk
+
+        parts.append('</sheetData></worksheet>')
+        sheet.write(''.join(parts).encode('utf-8'))
+
+    zf.writestr('xl/styles.xml', tostring(write_stylesheet(style_wb)))
+    zf.close()
+    _rows_processed.inc(len(data_df), stage='write')
+    yield sink.drain()
+
+
+# ========== 后台任务 ==========
+
+# 各处理阶段开始时的进度百分比
+JOB_STAGE_PERCENT = {
+    'queued': 0,
+    'reading': 5,
+    'deduplicating': 25,
+    'filtering': 45,
+    'writing': 60,
+    'done': 100,
+}
+
+# 每个任务保留的进度事件数
+JOB_EVENT_LIMIT = 1000
+
+# 写出多少行数据报告一次进度
+ROWS_PROGRESS_INTERVAL = 5000
+
+_jobs = {}
+_job_events = {}
+_jobs_lock = threading.Lock()
+_jobs_changed = threading.Condition(_jobs_lock)
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+_job_context = threading.local()
+
+
+def current_job_id():
+    """当前线程正在执行的后台任务编号"""
+    return getattr(_job_context, 'job_id', None)
+
+
+def _add_job_event_locked(job_id, event_type, data):
+    events = _job_events.get(job_id)
+    if events is None:
+        return
+    job = _jobs[job_id]
+    job['last_event_id'] += 1
+    events.append({'id': job['last_event_id'], 'event': event_type, 'data': data})
+    if len(events) > JOB_EVENT_LIMIT:
+        del events[0]
+    _jobs_changed.notify_all()
+
+
+def _update_job(job_id, event_type=None, event_data=None, **fields):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            job.update(fields)
+            job['updated_at'] = time.time()
+            if event_type is not None:
+                _add_job_event_locked(job_id, event_type, event_data)
+
+
+def report_progress(stage, percent=None, **details):
+    """报告当前后台任务的处理阶段，不在后台任务中执行时忽略"""
+    job_id = current_job_id()
+    if job_id is None:
+        return
+    if percent is None:
+        percent = JOB_STAGE_PERCENT.get(stage, 0)
+    percent = int(percent)
+    _update_job(job_id, event_type='progress', event_data=dict(details, stage=stage, percent=percent),
+                stage=stage, percent=percent)
+
+
+def record_rows_written(job_id, output_file, rows_written, total_rows):
+    """记录某个输出文件已写出的行数，任务结束后迟到的进度不再记录"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None and job['status'] not in ('finished', 'failed'):
+            _add_job_event_locked(job_id, 'rows', {
+                'file': os.path.basename(output_file),
+                'rows_written': rows_written,
+                'total_rows': total_rows
+            })
+
+
+def wait_job_events(job_id, after_event_id, timeout):
+    """等待编号大于after_event_id的事件
+
+    返回 (事件列表, 任务是否已结束)，任务不存在时返回 (None, True)。
+    """
+    deadline = time.time() + timeout
+    with _jobs_lock:
+        while True:
+            job = _jobs.get(job_id)
+            if job is None:
+                return None, True
+            events = [event for event in _job_events[job_id] if event['id'] > after_event_id]
+            finished = job['status'] in ('finished', 'failed')
+            remaining = deadline - time.time()
+            if events or finished or remaining <= 0:
+                return events, finished
+            _jobs_changed.wait(remaining)
+
+
+def _purge_finished_jobs():
+    """删除超过保留时间的已结束任务"""
+    expire_before = time.time() - JOB_RETENTION_SECONDS
+    with _jobs_lock:
+        for job_id in [job_id for job_id, job in _jobs.items()
+                       if job['status'] in ('finished', 'failed') and job['updated_at'] < expire_before]:
+            del _jobs[job_id]
+            del _job_events[job_id]
+
+
+def _run_job(job_id, func, params):
+    _job_context.job_id = job_id
+    _update_job(job_id, status='running')
+    try:
+        result = func(**params)
+        if result.get('success'):
+            _update_job(job_id, event_type='done', event_data=result,
+                        status='finished', stage='done', percent=100, result=result)
+        else:
+            _update_job(job_id, event_type='failed', event_data=result,
+                        status='failed', result=result, error=result.get('error'))
+    except Exception as e:
+        logger.error(f"后台任务出错: {job_id}: {e}")
+        error_msg = f'处理数据时出错: {str(e)}'
+        _update_job(job_id, event_type='failed', event_data={'success': False, 'error': error_msg},
+                    status='failed', error=error_msg)
+    finally:
+        _job_context.job_id = None
+
+
+def submit_job(job_type, func, params):
+    """提交后台任务，立即返回任务编号"""
+    _purge_finished_jobs()
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _jobs_lock:
+        _jobs[job_id] = {
+            'id': job_id,
+            'type': job_type,
+            'status': 'queued',
+            'stage': 'queued',
+            'percent': 0,
+            'result': None,
+            'error': None,
+            'created_at': now,
+            'updated_at': now,
+            'last_event_id': 0,
+        }
+        _job_events[job_id] = []
+    _job_executor.submit(_run_job, job_id, func, params)
+    logger.info(f"提交后台任务: {job_type} {job_id}")
+    return job_id
+
+
+def get_job(job_id):
+    """获取任务状态快照，任务不存在时返回None"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+
+# ========== 输出文件并行生成 ==========
+
+_output_pool = None
+_output_pool_lock = threading.Lock()
+_output_progress_queue = None
+
+# 子进程中用于回报写出行数的队列
+_worker_progress_queue = None
+
+# 等待子进程的写出进度全部转发完毕的最长时间（秒）
+OUTPUT_PROGRESS_FLUSH_SECONDS = 5
+
+# 子进程任务结束标记 -> 主进程转发到该标记时触发的事件
+_output_task_flushed = {}
+_output_task_flushed_lock = threading.Lock()
+
+
+def _init_output_worker(progress_queue):
+    global _worker_progress_queue
+    _worker_progress_queue = progress_queue
+
+
+def _forward_worker_progress(progress_queue):
+    """把子进程回报的写出行数转为任务事件，性能指标计入主进程"""
+    while True:
+        try:
+            message = progress_queue.get()
+            if message[0] == 'metric':
+                _, name, value, labels = message
+                _metrics[name].record(value, labels)
+            elif message[0] == 'flushed':
+                # 同一子进程的消息按顺序到达，此前该任务的写出进度均已转发
+                with _output_task_flushed_lock:
+                    flushed = _output_task_flushed.get(message[1])
+                if flushed is not None:
+                    flushed.set()
+            else:
+                _, job_id, output_file, rows_written, total_rows = message
+                record_rows_written(job_id, output_file, rows_written, total_rows)
+        except Exception as e:
+            logger.error(f"转发写出进度时出错: {e}")
+
+
+def report_rows_written(job_id, output_file, rows_written, total_rows):
+    """报告输出文件的写出行数，在子进程中通过队列转交主进程"""
+    if job_id is None:
+        return
+    if _worker_progress_queue is not None:
+        _worker_progress_queue.put(('rows', job_id, output_file, rows_written, total_rows))
+    else:
+        record_rows_written(job_id, output_file, rows_written, total_rows)
+
+
+def _create_output_in_worker(template_file, data_df, output_file, profile, job_id, flush_token):
+    """在子进程中生成输出文件，结束时在进度队列中放入结束标记"""
+    try:
+        return create_exact_copy_from_template(template_file, data_df, output_file, profile, job_id)
+    finally:
+        _worker_progress_queue.put(('flushed', flush_token))
+
+
+def _get_output_pool():
+    """获取常驻的输出进程池，子进程启动时即加载pandas和openpyxl"""
+    global _output_pool, _output_progress_queue
+    with _output_pool_lock:
+        if _output_pool is None:
+            mp_context = multiprocessing.get_context('spawn')
+            if _output_progress_queue is None:
+                _output_progress_queue = mp_context.Queue()
+                threading.Thread(target=_forward_worker_progress, args=(_output_progress_queue,),
+                                 name='output-progress', daemon=True).start()
+            logger.info(f"启动输出进程池: {OUTPUT_POOL_SIZE} 个进程")
+            _output_pool = ProcessPoolExecutor(
+                max_workers=OUTPUT_POOL_SIZE,
+                mp_context=mp_context,
+                initializer=_init_output_worker,
+                initargs=(_output_progress_queue,)
+            )
+        return _output_pool
+
+
+def _output_worker_ready(hold_seconds):
+    # 占用一段时间，使各预热任务分别落在不同的进程上
+    time.sleep(hold_seconds)
+    return os.getpid()
+
+
+def warm_output_pool():
+    """启动所有输出进程并等待其加载完成，避免首个请求承担进程启动和导入的耗时"""
+    pool = _get_output_pool()
+    futures = [pool.submit(_output_worker_ready, 0.5) for _ in range(OUTPUT_POOL_SIZE)]
+    worker_pids = {future.result() for future in futures}
+    logger.info(f"输出进程已就绪: {len(worker_pids)} 个")
+
+
+def _discard_output_pool(pool):
+    """丢弃已损坏的进程池，下次使用时重新创建"""
+    global _output_pool
+    with _output_pool_lock:
+        if _output_pool is pool:
+            _output_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def write_outputs(tasks):
+    """生成多个输出文件，tasks为 (模板文件, 数据, 输出文件) 列表
+
+    启用进程池时各文件并行生成，单个子进程异常只导致对应文件失败。
+    返回与tasks顺序一致的成功标志列表。
+    """
+    report_progress('writing')
+    job_id = current_job_id()
+    # 追踪中的请求在当前进程生成，以便记录每个文件的耗时和内存
+    if OUTPUT_POOL_SIZE <= 0 or not tasks or trace_active():
+        results = []
+        for template_file, data_df, output_file in tasks:
+            with trace_span('create_exact_copy_from_template', file=os.path.basename(output_file), rows=len(data_df)):
+                results.append(create_exact_copy_from_template(template_file, data_df, output_file, job_id=job_id))
+            _report_writing_progress(len(results), len(tasks))
+        return results
+
+    pool = _get_output_pool()
+    futures = []
+    flush_tokens = []
+    flush_events = {}
+    try:
+        for template_file, data_df, output_file in tasks:
+            # 模板格式在主进程读取一次后随任务传给子进程
+            profile = None
+            try:
+                profile = get_template_profile(template_file)
+            except Exception as e:
+                logger.error(f"读取模板格式时出错: {e}")
+            flush_token = uuid.uuid4().hex
+            flushed = threading.Event()
+            with _output_task_flushed_lock:
+                _output_task_flushed[flush_token] = flushed
+            flush_tokens.append(flush_token)
+            future = pool.submit(_create_output_in_worker, template_file, data_df, output_file,
+                                 profile, job_id, flush_token)
+            futures.append(future)
+            flush_events[future] = flushed
+
+        results = {}
+        future_outputs = {future: output_file for future, (_, _, output_file) in zip(futures, tasks)}
+        for future in as_completed(future_outputs):
+            output_file = future_outputs[future]
+            try:
+                results[future] = future.result()
+                # 子进程的写出进度经队列异步转发，等其转发完再报告整体进度，避免进度倒退
+                if not flush_events[future].wait(OUTPUT_PROGRESS_FLUSH_SECONDS):
+                    logger.warning(f"等待写出进度转发超时: {output_file}")
+            except BrokenProcessPool:
+                logger.error(f"输出进程异常退出，文件生成失败: {output_file}")
+                _discard_output_pool(pool)
+                results[future] = False
+            except Exception as e:
+                logger.error(f"生成输出文件时出错: {output_file}: {e}")
+                results[future] = False
+            _report_writing_progress(len(results), len(tasks))
+        return [results[future] for future in futures]
+    finally:
+        with _output_task_flushed_lock:
+            for flush_token in flush_tokens:
+                _output_task_flushed.pop(flush_token, None)
+
+
+def _report_writing_progress(done_count, total_count):
+    start = JOB_STAGE_PERCENT['writing']
+    report_progress('writing', start + (99 - start) * done_count / total_count)
+
+
 # ========== 其他工具函数 ==========
 
-def get_colleges_from_data(df):
-    """从数据中获取所有学院列表"""
-    college_columns = [col for col in df.columns if '院系' in col or '学院' in col or 'Address' in col]
+def pick_college_column(columns):
+    """按表头规则选出学院列"""
+    college_columns = [col for col in columns if '院系' in str(col) or '学院' in str(col) or 'Address' in str(col)]
     if college_columns:
-        college_column = college_columns[0]
-    else:
-        college_column = df.columns[1] if len(df.columns) > 1 else df.columns[0]
+        return college_columns[0]
+    return columns[1] if len(columns) > 1 else columns[0]
+
+
+def is_affiliation_column(college_column):
+    """学院列是否为WOS地址列（一个单元格含多个机构）"""
+    return 'Address' in str(college_column)
+
+
+# WOS地址中方括号内为作者名单，其中的分号不是机构分隔符
+_AUTHOR_GROUP_RE = re.compile(r'\[[^\]]*\]')
+_AFFILIATION_SEPARATOR_RE = re.compile(r'[;；\n]')
+
+
+def split_affiliations(cell):
+    """把地址单元格拆分为所属单位列表（按首次出现顺序去重）
+
+    WOS地址形如"[作者] 机构, 学院, 城市, 国家"：去掉作者名单后按分号拆分，
+    三段以上的地址去掉末尾的城市和国家，保留机构及其下第一级单位。
+    """
+    if cell is None:
+        return []
+    try:
+        if pd.isna(cell):
+            return []
+    except (TypeError, ValueError):
+        pass
+
+    affiliations = OrderedDict()
+    for part in _AFFILIATION_SEPARATOR_RE.split(_AUTHOR_GROUP_RE.sub('', str(cell))):
+        part = ' '.join(part.split()).strip(' ,，.')
+        if not part:
+            continue
+        components = [component.strip() for component in part.split(',')]
+        if len(components) >= 3:
+            part = ', '.join(component for component in components[:-2][:2] if component)
+        affiliations.setdefault(normalize_affiliation(part), part)
+    return list(affiliations.values())
+
+
+def normalize_affiliation(name):
+    """单位名的比较键：合并空白并忽略大小写"""
+    return ' '.join(str(name).split()).casefold()
+
+
+def get_colleges_from_data(df):
+    """从数据中获取所有学院列表，地址列按单位拆分"""
+    college_column = pick_college_column(list(df.columns))
+    if is_affiliation_column(college_column):
+        affiliations = OrderedDict()
+        for cell in df[college_column].dropna():
+            for name in split_affiliations(cell):
+                affiliations.setdefault(normalize_affiliation(name), name)
+        return list(affiliations.values()), college_column
     colleges = df[college_column].dropna().unique()
     return colleges.tolist(), college_column
 
 
-def reset_serial_numbers(data_df):
-    """重置序号列"""
+def _normalize_header(header):
+    """按pandas的规则处理表头：空表头记为Unnamed，重复表头加序号"""
+    columns = []
+    seen = {}
+    for idx, name in enumerate(header):
+        if name is None or name == '':
+            name = f"Unnamed: {idx}"
+        base_name = name
+        while name in seen:
+            seen[base_name] += 1
+            name = f"{base_name}.{seen[base_name]}"
+        seen.setdefault(name, 0)
+        columns.append(name)
+    return columns
+
+
+@timed('read')
+def scan_workbook_summary(file_path):
+    """以只读模式逐行扫描工作簿，不构建DataFrame
+
+    一次遍历得到记录数、学院列的不同取值和是否含WOS列，
+    内存占用只与学院数量有关。
+    """
+    wb = load_workbook(file_path, read_only=True)
+    try:
+        ws = wb.active
+        # 部分导出文件的尺寸信息不准确，按实际内容遍历
+        ws.reset_dimensions()
+        rows = ws.iter_rows(values_only=True)
+        columns = _normalize_header(next(rows, ()))
+        if not columns:
+            raise ValueError('表格没有表头')
+
+        college_column = pick_college_column(columns)
+        college_idx = columns.index(college_column)
+        split_cell = is_affiliation_column(college_column)
+        row_count = 0
+        record_count = 0
+        colleges = {}
+        for row in rows:
+            row_count += 1
+            if all(value is None or value == '' for value in row):
+                continue
+            # 与pandas一致，末尾的空行不计入记录数
+            record_count = row_count
+            if college_idx < len(row) and row[college_idx] is not None:
+                if split_cell:
+                    for name in split_affiliations(row[college_idx]):
+                        colleges.setdefault(normalize_affiliation(name), name)
+                else:
+                    colleges.setdefault(row[college_idx], row[college_idx])
+
+        _rows_processed.inc(record_count, stage='read')
+        return {
+            'record_count': record_count,
+            'colleges': list(colleges.values()),
+            'college_column': college_column,
+            'has_wos': WOS_COLUMN in columns
+        }
+    finally:
+        wb.close()
+
+
+def save_upload_by_hash(stream, filename):
+    """边写入磁盘边计算SHA-256，文件以内容哈希命名保存
+
+    相同内容的文件已存在时直接复用（保留原文件及其修改时间，
+    已有的列式副本和索引继续有效）。返回 (文件路径, 内容哈希)。
+    """
+    os.makedirs('uploads', exist_ok=True)
+    extension = os.path.splitext(filename)[1].lower()
+    tmp_path = os.path.join('uploads', f".{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as tmp_file:
+            while True:
+                chunk = stream.read(1024 * 1024)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                tmp_file.write(chunk)
+
+        content_hash = digest.hexdigest()
+        file_path = os.path.join('uploads', f"{content_hash}{extension}")
+        if os.path.exists(file_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, file_path)
+        return file_path, content_hash
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_upload_summary(content_hash):
+    """读取已保存的上传文件摘要，不存在时返回None"""
+    summary_path = os.path.join(UPLOAD_META_DIR, f"{content_hash}.json")
+    try:
+        with open(summary_path, encoding='utf-8') as f:
+            summary = json.load(f)
+        return summary if summary.get('version') == UPLOAD_SUMMARY_VERSION else None
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"读取上传文件摘要时出错: {e}")
+        return None
+
+
+def save_upload_summary(content_hash, summary):
+    """保存上传文件摘要"""
+    try:
+        os.makedirs(UPLOAD_META_DIR, exist_ok=True)
+        summary_path = os.path.join(UPLOAD_META_DIR, f"{content_hash}.json")
+        tmp_path = f"{summary_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(summary, version=UPLOAD_SUMMARY_VERSION), f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, summary_path)
+    except Exception as e:
+        logger.error(f"保存上传文件摘要时出错: {e}")
+
+
+def summarize_workbook(file_path):
+    """获取上传文件的摘要，.xls等openpyxl无法读取的格式退回pandas"""
+    if file_path.endswith('.xlsx'):
+        return scan_workbook_summary(file_path)
+
+    df = read_excel_cached(file_path)
+    colleges, college_column = get_colleges_from_data(df)
+    return {
+        'record_count': len(df),
+        'colleges': colleges,
+        'college_column': college_column,
+        'has_wos': WOS_COLUMN in df.columns
+    }
+
+
+@timed('serial_reset')
+def reset_serial_numbers(data_df, start=1):
+    """重置序号列，分批写出时start为本批第一行的序号"""
     number_columns = [col for col in data_df.columns if any(keyword in str(col) for keyword in
                                                             ['Number', '序号', '编号', 'No.', 'NO', '编号'])]
 
     if number_columns:
         number_column = number_columns[0]
-        data_df[number_column] = range(1, len(data_df) + 1)
+        data_df[number_column] = range(start, start + len(data_df))
     else:
         first_col_name = str(data_df.columns[0])
         if any(keyword in first_col_name for keyword in ['Number', '序号', '编号', 'No.', 'NO']):
-            data_df.iloc[:, 0] = range(1, len(data_df) + 1)
+            data_df.iloc[:, 0] = range(start, start + len(data_df))
 
     return data_df
 
@@ -285,34 +1650,524 @@ def get_safe_filename(name):
     return safe_name
 
 
-def get_unique_filename(directory, base_name, extension):
-    """生成唯一的文件名"""
+def get_unique_filename(directory, base_name, extension, reserved=None):
+    """生成唯一的文件名，reserved为本批次已占用但尚未写出的路径集合"""
     safe_base_name = get_safe_filename(base_name)
     counter = 1
     file_path = os.path.join(directory, f"{safe_base_name}{extension}")
+    reserved = reserved if reserved is not None else set()
 
-    while os.path.exists(file_path):
+    while os.path.exists(file_path) or file_path in reserved:
         file_path = os.path.join(directory, f"{safe_base_name}_{counter}{extension}")
         counter += 1
 
+    reserved.add(file_path)
     return file_path
 
 
+# ========== 学院索引 ==========
+
+class _RowIndex:
+    """学院到行号的索引基类
+
+    行号指源文件中的位置，查重后的数据保留源文件的行号，可以直接使用。
+    子类提供 row_count、positions、counts 和 groups。
+    """
+
+    def covers(self, data_df):
+        """数据的行标签是否为源文件中的行号（源文件数据本身或其行子集）"""
+        if len(data_df) == 0:
+            return True
+        index = data_df.index
+        return index.dtype.kind in 'iu' and index.min() >= 0 and index.max() < self.row_count
+
+    def row_positions(self, data_df):
+        """数据行在源文件中的行号，数据即整个源文件时返回None"""
+        if len(data_df) == self.row_count:
+            return None
+        return data_df.index.to_numpy()
+
+    def selection_mask(self, colleges, row_positions=None):
+        """所选学院的行掩码，row_positions指定时只取这些行"""
+        selected = np.zeros(self.row_count, dtype=bool)
+        selected[self.positions(colleges)] = True
+        return selected if row_positions is None else selected[row_positions]
+
+
+class CollegeIndex(_RowIndex):
+    """学院列的分类编码索引，每个学院对应的行号在建立索引时一次算好
+
+    筛选、剩余数据和计数只需按学院取出行号，不再逐行比较字符串。
+    """
+
+    def __init__(self, values):
+        categorical = pd.Categorical(values)
+        self.row_count = len(categorical)
+        self.codes = categorical.codes
+        self.categories = categorical.categories
+        self._labels = categorical.categories.tolist()
+
+        # 按编码稳定排序后每个学院的行号是连续的一段（缺失值编码为-1，排在最前）
+        self._order = np.argsort(self.codes, kind='stable')
+        counts = np.bincount(self.codes + 1, minlength=len(self._labels) + 1)
+        self._offsets = np.concatenate(([0], np.cumsum(counts)))
+        self._counts = counts[1:]
+
+    def positions(self, colleges):
+        """所选学院的行号（升序）"""
+        chunks = [self._order[self._offsets[code + 1]:self._offsets[code + 2]]
+                  for code in self.categories.get_indexer(colleges) if code >= 0]
+        if not chunks:
+            return np.empty(0, dtype=np.intp)
+        return chunks[0] if len(chunks) == 1 else np.sort(np.concatenate(chunks))
+
+    def counts(self, row_positions=None):
+        """各学院的记录数，按记录数从多到少排列"""
+        if row_positions is None:
+            counts = self._counts
+        else:
+            codes = self.codes[row_positions]
+            counts = np.bincount(codes[codes >= 0], minlength=len(self._labels))
+        college_counts = {self._labels[code]: int(counts[code]) for code in np.flatnonzero(counts)}
+        return dict(sorted(college_counts.items(), key=lambda item: -item[1]))
+
+    def groups(self, row_positions=None):
+        """按学院分组的行号，学院按首次出现的顺序排列，没有学院的行最后以None返回"""
+        if row_positions is None:
+            row_positions = np.arange(self.row_count)
+        codes = self.codes[row_positions]
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order]
+        boundaries = np.flatnonzero(np.diff(sorted_codes)) + 1
+        chunks = np.split(row_positions[order], boundaries) if len(codes) else []
+        chunk_codes = sorted_codes[np.concatenate(([0], boundaries))] if len(codes) else []
+
+        groups = [(self._labels[code], chunk) for code, chunk in zip(chunk_codes, chunks) if code >= 0]
+        groups.sort(key=lambda group: group[1][0])
+        groups += [(None, chunk) for code, chunk in zip(chunk_codes, chunks) if code < 0]
+        return groups
+
+
+class AffiliationIndex(_RowIndex):
+    """地址列的倒排索引：每个单元格拆分为多个单位，每个单位对应包含它的行号
+
+    一篇论文可以属于多个单位，按任一单位匹配筛选；
+    各单位的计数之和可能大于记录数。
+    """
+
+    def __init__(self, values):
+        self.row_count = len(values)
+        postings = OrderedDict()
+        labels = {}
+        self._has_affiliation = np.zeros(self.row_count, dtype=bool)
+        for row, cell in enumerate(values):
+            for name in split_affiliations(cell):
+                key = normalize_affiliation(name)
+                labels.setdefault(key, name)
+                postings.setdefault(key, []).append(row)
+                self._has_affiliation[row] = True
+
+        self._keys = {key: code for code, key in enumerate(postings)}
+        self._labels = [labels[key] for key in postings]
+        self._postings = [np.array(rows, dtype=np.intp) for rows in postings.values()]
+
+    def positions(self, colleges):
+        """与任一所选单位相关的行号（升序）"""
+        codes = {self._keys.get(normalize_affiliation(college)) for college in colleges} - {None}
+        if not codes:
+            return np.empty(0, dtype=np.intp)
+        if len(codes) == 1:
+            return self._postings[codes.pop()]
+        return np.unique(np.concatenate([self._postings[code] for code in codes]))
+
+    def _member_mask(self, row_positions):
+        if row_positions is None:
+            return None
+        member = np.zeros(self.row_count, dtype=bool)
+        member[row_positions] = True
+        return member
+
+    def counts(self, row_positions=None):
+        """各单位的记录数，按记录数从多到少排列"""
+        member = self._member_mask(row_positions)
+        college_counts = {}
+        for label, rows in zip(self._labels, self._postings):
+            count = len(rows) if member is None else int(np.count_nonzero(member[rows]))
+            if count:
+                college_counts[label] = count
+        return dict(sorted(college_counts.items(), key=lambda item: -item[1]))
+
+    def groups(self, row_positions=None):
+        """按单位分组的行号（同一行可出现在多个单位中），没有单位的行最后以None返回"""
+        member = self._member_mask(row_positions)
+        groups = []
+        for label, rows in zip(self._labels, self._postings):
+            if member is not None:
+                rows = rows[member[rows]]
+            if len(rows):
+                groups.append((label, rows))
+        groups.sort(key=lambda group: group[1][0])
+
+        unassigned = ~self._has_affiliation if member is None else member & ~self._has_affiliation
+        if unassigned.any():
+            groups.append((None, np.flatnonzero(unassigned)))
+        return groups
+
+
+def build_college_index(college_column, values):
+    """按学院列类型建立索引：地址列用倒排索引，其他列用分类编码索引"""
+    if is_affiliation_column(college_column):
+        return AffiliationIndex(values)
+    return CollegeIndex(values)
+
+
+_college_index_cache = SizedLRUCache(COLLEGE_INDEX_CACHE_SIZE, lambda index: 1)
+
+
+def get_college_index(file_path, college_column):
+    """获取文件学院列的索引，同一文件的同一列只建立一次；找不到该列时返回None"""
+    cache_key = (get_file_signature(file_path), college_column)
+    index = _college_index_cache.get(cache_key)
+    record_cache_lookup('college_index', index is not None)
+    if index is None:
+        df = read_excel_cached(file_path, columns=[college_column])
+        if college_column not in df.columns:
+            return None
+        logger.debug(f"建立学院索引: {file_path} [{college_column}]")
+        index = build_college_index(college_column, df[college_column].reset_index(drop=True))
+        _college_index_cache.put(cache_key, index)
+    return index
+
+
+@timed('filter')
+def college_selection_mask(data_df, source_file, college_column, selected_college):
+    """所选学院的行掩码，数据来自source_file时使用学院索引（source_file为None时不使用）"""
+    _rows_processed.inc(len(data_df), stage='filter')
+    colleges = college_list(selected_college)
+    index = get_college_index(source_file, college_column) if source_file else None
+    if index is not None and index.covers(data_df):
+        return index.selection_mask(colleges, index.row_positions(data_df))
+    if is_affiliation_column(college_column):
+        return AffiliationIndex(data_df[college_column].tolist()).selection_mask(colleges)
+    return data_df[college_column].isin(colleges).to_numpy()
+
+
+@timed('filter')
+def college_counts(data_df, source_file, college_column):
+    """各学院的记录数，数据来自source_file时使用学院索引（source_file为None时不使用）"""
+    _rows_processed.inc(len(data_df), stage='filter')
+    index = get_college_index(source_file, college_column) if source_file else None
+    if index is not None and index.covers(data_df):
+        return index.counts(index.row_positions(data_df))
+    if is_affiliation_column(college_column):
+        return AffiliationIndex(data_df[college_column].tolist()).counts()
+    return data_df[college_column].value_counts().to_dict()
+
+
+# ========== WOS编号索引 ==========
+
+WOS_COLUMN = 'WOS Accession Number'
+
+_wos_index_lock = threading.Lock()
+
+
+def _connect_wos_index():
+    os.makedirs(os.path.dirname(WOS_INDEX_PATH), exist_ok=True)
+    conn = sqlite3.connect(WOS_INDEX_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sources (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            label TEXT,
+            in_library INTEGER NOT NULL DEFAULT 0,
+            record_count INTEGER NOT NULL,
+            registered_at REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS accessions (
+            accession TEXT NOT NULL,
+            source_id INTEGER NOT NULL,
+            PRIMARY KEY (accession, source_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS accessions_source ON accessions (source_id)")
+    return conn
+
+
+def _read_wos_accessions(file_path):
+    """读取文件中不重复的WOS编号，返回 (编号集合, 记录数)，找不到WOS列时编号集合为None
+
+    大文件分批读取WOS列，只保留编号本身。
+    """
+    if use_chunked_reading(file_path):
+        batches = iter_excel_batches(file_path, columns=[WOS_COLUMN])
+    else:
+        batches = iter([read_excel_cached(file_path, columns=[WOS_COLUMN])])
+    accessions = None
+    record_count = 0
+    for batch in batches:
+        if WOS_COLUMN not in batch.columns:
+            return None, 0
+        if accessions is None:
+            accessions = set()
+        record_count += len(batch)
+        accessions.update(batch[WOS_COLUMN].dropna().astype(str).unique())
+    return accessions, record_count
+
+
+def _prune_wos_sources_locked(conn):
+    """删除文件已不存在的非历史库来源，并只保留最近登记的WOS_INDEX_MAX_SOURCES个非历史库来源"""
+    rows = conn.execute(
+        "SELECT id, path FROM sources WHERE in_library = 0 ORDER BY registered_at DESC").fetchall()
+    stale = [row[0] for row in rows if not os.path.exists(row[1])]
+    missing = set(stale)
+    kept = [row[0] for row in rows if row[0] not in missing]
+    stale.extend(kept[WOS_INDEX_MAX_SOURCES:])
+    for source_id in stale:
+        conn.execute("DELETE FROM accessions WHERE source_id = ?", (source_id,))
+        conn.execute("DELETE FROM sources WHERE id = ?", (source_id,))
+    if stale:
+        logger.info(f"清理WOS编号索引中的 {len(stale)} 个来源")
+
+
+def _lookup_wos_source_locked(conn, abs_path, size, mtime_ns, label, in_library):
+    """文件已登记且未变化时返回来源编号（并更新历史库标记和名称），否则返回None"""
+    row = conn.execute("SELECT id, size, mtime_ns FROM sources WHERE path = ?", (abs_path,)).fetchone()
+    if row is None or row[1] != size or row[2] != mtime_ns:
+        return None
+    if in_library or label:
+        with conn:
+            conn.execute(
+                "UPDATE sources SET in_library = MAX(in_library, ?), label = COALESCE(?, label) WHERE id = ?",
+                (int(in_library), label, row[0]))
+    return row[0]
+
+
+_wos_register_locks = KeyedLocks()
+
+
+def register_wos_source(file_path, label=None, in_library=False):
+    """把文件中的WOS编号登记到索引，同一文件未变化时不重复读取
+
+    in_library为True时该文件加入历史库，参与"与历史库查重"。文件在索引锁之外读取，
+    读取期间不阻塞其他文件的查重和登记。返回 (来源编号, 错误信息)。
+    """
+    abs_path, size, mtime_ns = get_file_signature(file_path)
+    with _wos_index_lock:
+        conn = _connect_wos_index()
+        try:
+            source_id = _lookup_wos_source_locked(conn, abs_path, size, mtime_ns, label, in_library)
+        finally:
+            conn.close()
+    if source_id is not None:
+        return source_id, None
+
+    # 同一文件并发登记时只读取一次
+    with _wos_register_locks.hold(abs_path):
+        with _wos_index_lock:
+            conn = _connect_wos_index()
+            try:
+                source_id = _lookup_wos_source_locked(conn, abs_path, size, mtime_ns, label, in_library)
+            finally:
+                conn.close()
+        if source_id is not None:
+            return source_id, None
+
+        accessions, record_count = _read_wos_accessions(file_path)
+        if accessions is None:
+            return None, f"文件中找不到'{WOS_COLUMN}'列: {os.path.basename(file_path)}"
+
+        with _wos_index_lock:
+            conn = _connect_wos_index()
+            try:
+                with conn:
+                    row = conn.execute("SELECT id FROM sources WHERE path = ?", (abs_path,)).fetchone()
+                    if row is not None:
+                        # 文件已变化，重新登记
+                        conn.execute("DELETE FROM accessions WHERE source_id = ?", (row[0],))
+                        conn.execute(
+                            "UPDATE sources SET size = ?, mtime_ns = ?, record_count = ?, registered_at = ?, "
+                            "in_library = MAX(in_library, ?), label = COALESCE(?, label) WHERE id = ?",
+                            (size, mtime_ns, record_count, time.time(), int(in_library), label, row[0]))
+                        source_id = row[0]
+                    else:
+                        cursor = conn.execute(
+                            "INSERT INTO sources (path, size, mtime_ns, label, in_library, record_count, "
+                            "registered_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (abs_path, size, mtime_ns, label, int(in_library), record_count, time.time()))
+                        source_id = cursor.lastrowid
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO accessions (accession, source_id) VALUES (?, ?)",
+                        ((accession, source_id) for accession in accessions))
+                    _prune_wos_sources_locked(conn)
+            finally:
+                conn.close()
+        logger.info(f"登记WOS编号: {file_path} ({record_count} 条记录)")
+        return source_id, None
+
+
+def list_wos_sources():
+    """列出索引中登记的文件"""
+    conn = _connect_wos_index()
+    try:
+        rows = conn.execute(
+            "SELECT s.id, s.path, s.label, s.in_library, s.record_count, s.registered_at, "
+            "(SELECT COUNT(*) FROM accessions a WHERE a.source_id = s.id) "
+            "FROM sources s ORDER BY s.id").fetchall()
+    finally:
+        conn.close()
+    return [{
+        'id': row[0],
+        'path': row[1],
+        'label': row[2],
+        'in_library': bool(row[3]),
+        'record_count': row[4],
+        'registered_at': row[5],
+        'accession_count': row[6]
+    } for row in rows]
+
+
+def remove_wos_source(source_id):
+    """从索引中删除一个文件的登记，返回是否存在"""
+    with _wos_index_lock:
+        conn = _connect_wos_index()
+        try:
+            with conn:
+                conn.execute("DELETE FROM accessions WHERE source_id = ?", (source_id,))
+                deleted = conn.execute("DELETE FROM sources WHERE id = ?", (source_id,)).rowcount
+        finally:
+            conn.close()
+    return deleted > 0
+
+
+def library_source_ids():
+    """历史库中的所有来源编号"""
+    conn = _connect_wos_index()
+    try:
+        return [row[0] for row in conn.execute("SELECT id FROM sources WHERE in_library = 1")]
+    finally:
+        conn.close()
+
+
+def library_fingerprint():
+    """历史库当前内容的标识，历史库变化后处理结果缓存随之失效"""
+    conn = _connect_wos_index()
+    try:
+        return [list(row) for row in conn.execute(
+            "SELECT id, size, mtime_ns FROM sources WHERE in_library = 1 ORDER BY id")]
+    finally:
+        conn.close()
+
+
+def find_indexed_accessions(accessions, source_ids):
+    """返回accessions中已登记在指定来源里的WOS编号集合"""
+    probe = pd.Series(accessions).dropna().astype(str).unique()
+    if len(probe) == 0 or not source_ids:
+        return set()
+
+    conn = _connect_wos_index()
+    try:
+        conn.execute("CREATE TEMP TABLE probe (accession TEXT PRIMARY KEY) WITHOUT ROWID")
+        conn.executemany("INSERT OR IGNORE INTO probe (accession) VALUES (?)", ((a,) for a in probe))
+        placeholders = ','.join('?' * len(source_ids))
+        rows = conn.execute(
+            f"SELECT DISTINCT p.accession FROM probe p JOIN accessions a ON a.accession = p.accession "
+            f"WHERE a.source_id IN ({placeholders})", list(source_ids)).fetchall()
+    finally:
+        conn.close()
+    return {row[0] for row in rows}
+
+
 # ========== 核心功能函数 ==========
 
+@timed('dedupe')
+def deduplicate_by_wos(check_df, main_file_path, dedupe_against_history=False):
+    """从查重数据中删除主文件（及历史库）已有的WOS编号
+
+    主文件的WOS编号登记在持久索引中，只在首次使用时读取主文件。
+    返回 (去重后数据, 错误信息)。
+    """
+    if WOS_COLUMN not in check_df.columns:
+        return None, f"查重文件中找不到'{WOS_COLUMN}'列"
+
+    main_source_id, error_msg = register_wos_source(main_file_path)
+    if error_msg:
+        return None, f"主文件中找不到'{WOS_COLUMN}'列"
+
+    source_ids = {main_source_id}
+    if dedupe_against_history:
+        source_ids.update(library_source_ids())
+
+    # 在索引中查找查重文件的WOS编号，再按结果向量化过滤
+    check_wos_numbers = check_df[WOS_COLUMN]
+    with trace_span('find_indexed_accessions', rows=len(check_df)):
+        known_wos_numbers = find_indexed_accessions(check_wos_numbers, sorted(source_ids))
+    with trace_span('isin', rows=len(check_df), known=len(known_wos_numbers)):
+        is_duplicate = check_wos_numbers.notna() & check_wos_numbers.astype(str).isin(known_wos_numbers)
+
+    # 从查重文件中删除重复数据
+    deduplicated_df = check_df[~is_duplicate]
+    _rows_processed.inc(len(check_df), stage='dedupe')
+    return deduplicated_df, None
+
+
+def load_working_dataset(main_file_path, check_file_path=None, use_deduplication=False,
+                         dedupe_against_history=False, columns=None):
+    """读取待筛选数据（查重模式下为去重后的查重文件）
+
+    columns指定时只读取这些列（查重时自动包含WOS列），用于只需计数的场景。
+    返回 (数据, 原始记录数, 删除的重复数, 模板文件, 错误信息)
+    """
+    report_progress('reading')
+    if use_deduplication and check_file_path:
+        if columns is not None:
+            columns = [WOS_COLUMN] + [col for col in columns if col != WOS_COLUMN]
+        check_df = read_excel_cached(check_file_path, columns)
+        logger.info(f"查重文件记录数: {len(check_df)}")
+
+        report_progress('deduplicating')
+        deduplicated_df, error_msg = deduplicate_by_wos(check_df, main_file_path, dedupe_against_history)
+        if error_msg:
+            return None, None, None, None, error_msg
+        removed_count = len(check_df) - len(deduplicated_df)
+        logger.info(f"去重后记录数: {len(deduplicated_df)}")
+        logger.info(f"删除的记录数: {removed_count}")
+        report_progress('deduplicating', percent=JOB_STAGE_PERCENT['filtering'] - 1,
+                        record_count=len(check_df), removed_count=removed_count)
+        return deduplicated_df, len(check_df), removed_count, check_file_path, None
+
+    main_df = read_excel_cached(main_file_path, columns)
+    logger.info(f"原始数据记录数: {len(main_df)}")
+    return main_df, len(main_df), 0, main_file_path, None
+
+
+def college_list(selected_college):
+    """所选学院统一为列表，可以传入单个学院名或学院名列表"""
+    if isinstance(selected_college, (list, tuple)):
+        return list(OrderedDict.fromkeys(selected_college))
+    return [selected_college]
+
+
 def filter_by_college_only(main_file_path, selected_college, college_column):
-    """仅按学院筛选（不进行查重）"""
+    """仅按学院筛选（不进行查重），selected_college可以是多个学院的列表"""
     try:
         logger.info(f"开始学院筛选: {selected_college}")
-        main_df = pd.read_excel(main_file_path)
+        report_progress('reading')
+        main_df = read_excel_cached(main_file_path)
         original_count = len(main_df)
 
         logger.info(f"原始数据记录数: {original_count}")
         logger.info(f"学院列: {college_column}")
 
         # 筛选指定学院
-        college_papers = main_df[main_df[college_column] == selected_college].copy()
-        remaining_papers = main_df[main_df[college_column] != selected_college].copy()
+        report_progress('filtering')
+        college_mask = college_selection_mask(main_df, main_file_path, college_column, selected_college)
+        college_papers = main_df[college_mask].copy()
+        remaining_papers = main_df[~college_mask].copy()
 
         logger.info(f"筛选出的学院论文数: {len(college_papers)}")
         logger.info(f"剩余论文数: {len(remaining_papers)}")
@@ -328,39 +2183,26 @@ def filter_by_college_only(main_file_path, selected_college, college_column):
         return None, None, None, f"学院筛选时出错: {str(e)}"
 
 
-def correct_deduplicate_and_filter(check_file_path, main_file_path, selected_college, college_column):
+def correct_deduplicate_and_filter(check_file_path, main_file_path, selected_college, college_column,
+                                   dedupe_against_history=False):
     """修正的查重逻辑"""
     try:
         logger.info("=== 开始查重处理 ===")
 
-        # 读取文件
-        check_df = pd.read_excel(check_file_path)
-        main_df = pd.read_excel(main_file_path)
-
-        logger.info(f"查重文件记录数: {len(check_df)}")
-        logger.info(f"主文件记录数: {len(main_df)}")
-
-        # 检查WOS列
-        if 'WOS Accession Number' not in check_df.columns:
-            return None, None, None, None, "查重文件中找不到'WOS Accession Number'列"
-        if 'WOS Accession Number' not in main_df.columns:
-            return None, None, None, None, "主文件中找不到'WOS Accession Number'列"
-
-        # 获取主文件中的WOS编号
-        main_wos_numbers = set(main_df['WOS Accession Number'].dropna().unique())
-
-        # 从查重文件中删除重复数据
-        deduplicated_df = check_df[~check_df['WOS Accession Number'].isin(main_wos_numbers)]
-
-        logger.info(f"去重后记录数: {len(deduplicated_df)}")
-        logger.info(f"删除的记录数: {len(check_df) - len(deduplicated_df)}")
+        deduplicated_df, original_count, removed_count, _, error_msg = load_working_dataset(
+            main_file_path, check_file_path, use_deduplication=True,
+            dedupe_against_history=dedupe_against_history)
+        if error_msg:
+            return None, None, None, None, error_msg
 
         # 筛选指定学院
+        report_progress('filtering')
         if college_column not in deduplicated_df.columns:
             return None, None, None, None, f"查重文件中找不到学院列: {college_column}"
 
-        college_papers = deduplicated_df[deduplicated_df[college_column] == selected_college].copy()
-        remaining_papers = deduplicated_df[deduplicated_df[college_column] != selected_college].copy()
+        college_mask = college_selection_mask(deduplicated_df, check_file_path, college_column, selected_college)
+        college_papers = deduplicated_df[college_mask].copy()
+        remaining_papers = deduplicated_df[~college_mask].copy()
 
         logger.info(f"学院'{selected_college}'论文数: {len(college_papers)}")
         logger.info(f"剩余论文数: {len(remaining_papers)}")
@@ -369,56 +2211,1191 @@ def correct_deduplicate_and_filter(check_file_path, main_file_path, selected_col
         college_papers = reset_serial_numbers(college_papers)
         remaining_papers = reset_serial_numbers(remaining_papers)
 
-        return college_papers, remaining_papers, len(check_df), len(check_df) - len(deduplicated_df), None
+        return college_papers, remaining_papers, original_count, removed_count, None
 
     except Exception as e:
         logger.error(f"查重筛选错误: {str(e)}")
         return None, None, None, None, f"查重筛选时出错: {str(e)}"
 
 
-def get_correct_deduplicated_stats(check_file_path, main_file_path, college_column):
+def get_correct_deduplicated_stats(check_file_path, main_file_path, college_column, dedupe_against_history=False):
     """获取正确的查重后学院统计"""
     try:
         logger.info("=== 获取查重统计 ===")
 
-        # 读取文件
-        check_df = pd.read_excel(check_file_path)
-        main_df = pd.read_excel(main_file_path)
-
-        logger.info(f"统计 - 查重文件: {len(check_df)} 条")
-        logger.info(f"统计 - 主文件: {len(main_df)} 条")
-
-        # 检查WOS列
-        if 'WOS Accession Number' not in check_df.columns or 'WOS Accession Number' not in main_df.columns:
-            logger.error("错误: 缺少WOS列")
+        deduplicated_df, _, _, _, error_msg = load_working_dataset(
+            main_file_path, check_file_path, use_deduplication=True,
+            dedupe_against_history=dedupe_against_history, columns=[college_column])
+        if error_msg:
+            logger.error(f"错误: {error_msg}")
             return {}
 
-        # 获取主文件中的WOS编号
-        main_wos_numbers = set(main_df['WOS Accession Number'].dropna().unique())
-
-        # 从查重文件中删除重复数据
-        deduplicated_df = check_df[~check_df['WOS Accession Number'].isin(main_wos_numbers)]
-
-        logger.info(f"统计 - 去重后: {len(deduplicated_df)} 条")
-        logger.info(f"统计 - 删除数: {len(check_df) - len(deduplicated_df)} 条")
-
         # 获取学院统计
         if college_column not in deduplicated_df.columns:
             logger.error(f"错误: 找不到学院列 {college_column}")
             return {}
 
-        college_counts = deduplicated_df[college_column].value_counts().to_dict()
-        logger.info(f"学院统计: {college_counts}")
+        college_stats = college_counts(deduplicated_df, check_file_path, college_column)
+        logger.info(f"学院统计: {college_stats}")
 
-        return college_counts
+        return college_stats
 
     except Exception as e:
         logger.error(f"获取查重统计错误: {str(e)}")
         return {}
 
 
+@timed('filter')
+def group_by_college(data_df, college_column, source_file=None):
+    """按学院分组，返回 (学院, 数据) 列表，没有学院信息的记录学院为None、排在最后
+
+    数据来自source_file时按学院索引分组。
+    """
+    _rows_processed.inc(len(data_df), stage='filter')
+    groups = []
+    index = get_college_index(source_file, college_column) if source_file else None
+    if index is not None and index.covers(data_df):
+        for college, positions in index.groups(index.row_positions(data_df)):
+            groups.append((str(college) if college is not None else None, data_df.loc[positions]))
+    elif is_affiliation_column(college_column):
+        for college, positions in AffiliationIndex(data_df[college_column].tolist()).groups():
+            groups.append((college, data_df.iloc[positions]))
+    else:
+        for college, college_papers in data_df.groupby(college_column, sort=False, observed=True):
+            groups.append((str(college), college_papers))
+        unassigned_papers = data_df[data_df[college_column].isna()]
+        if len(unassigned_papers) > 0:
+            groups.append((None, unassigned_papers))
+    return groups
+
+
+def split_all_colleges(data_df, college_column, template_file, source_file=None):
+    """按学院一次性拆分数据，每个学院输出一个文件，返回文件清单
+
+    数据来自source_file时按学院索引分组，没有学院信息的记录单独输出。
+    """
+    groups = group_by_college(data_df, college_column, source_file)
+
+    reserved = cached_output_paths()
+    tasks = []
+    for college_name, college_papers in groups:
+        college_papers = reset_serial_numbers(college_papers.copy())
+        base_name = get_safe_filename(college_name) if college_name is not None else "未分类数据"
+        output_file = get_unique_filename('outputs', base_name, ".xlsx", reserved)
+        tasks.append((template_file, college_papers, output_file))
+
+    results = write_outputs(tasks)
+
+    manifest = []
+    for (college_name, _), (_, college_papers, output_file), success in zip(groups, tasks, results):
+        manifest.append({
+            'college': college_name,
+            'file': os.path.basename(output_file) if success else None,
+            'count': len(college_papers),
+            'success': success
+        })
+        logger.info(f"拆分学院'{college_name}': {len(college_papers)} 条 -> {output_file}")
+
+    return manifest
+
+
+# ========== 处理结果缓存 ==========
+
+_content_hashes = {}
+_result_cache_lock = threading.Lock()
+
+
+def get_content_hash(file_path):
+    """文件内容的SHA-256，按内容哈希保存的上传文件直接取文件名"""
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    if len(stem) == 64 and all(ch in '0123456789abcdef' for ch in stem):
+        return stem
+
+    signature = get_file_signature(file_path)
+    content_hash = _content_hashes.get(signature)
+    if content_hash is None:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        content_hash = digest.hexdigest()
+        _content_hashes[signature] = content_hash
+    return content_hash
+
+
+def result_cache_key(kind, main_file_path, check_file_path, selected_college, college_column,
+                     use_deduplication, dedupe_against_history):
+    """处理结果的缓存键：输入文件内容、所选学院及学院列和查重方式"""
+    use_deduplication = bool(use_deduplication and check_file_path)
+    key = {
+        'kind': kind,
+        'main': get_content_hash(main_file_path),
+        'check': get_content_hash(check_file_path) if use_deduplication else None,
+        'college': selected_college,
+        'college_column': college_column,
+        'deduplication': use_deduplication,
+        'library': library_fingerprint() if use_deduplication and dedupe_against_history else None,
+    }
+    return json.dumps(key, ensure_ascii=False, sort_keys=True, default=str)
+
+
+def _load_result_cache():
+    try:
+        with open(RESULT_CACHE_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"读取处理结果缓存时出错: {e}")
+        return {}
+
+
+def _save_result_cache(entries):
+    tmp_path = f"{RESULT_CACHE_PATH}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entries, f, ensure_ascii=False, default=str)
+    os.replace(tmp_path, RESULT_CACHE_PATH)
+
+
+def _output_path(name):
+    return os.path.join('outputs', name)
+
+
+def _entry_size(entry):
+    return sum(os.path.getsize(_output_path(name)) for name in entry['files'] if os.path.exists(_output_path(name)))
+
+
+def _entry_available(entry):
+    """结果文件都已生成，或未生成的文件可以按记录的参数重新生成"""
+    for name in entry['files']:
+        if os.path.exists(_output_path(name)):
+            continue
+        if not entry.get('recipe') or name not in entry.get('parts', {}):
+            return False
+    return True
+
+
+def lookup_cached_result(cache_key):
+    """查找已有的处理结果，结果文件仍然可用时返回响应数据"""
+    with _result_cache_lock:
+        entries = _load_result_cache()
+        entry = entries.get(cache_key)
+        if entry is None:
+            record_cache_lookup('result', False)
+            return None
+        if not _entry_available(entry):
+            del entries[cache_key]
+            _save_result_cache(entries)
+            record_cache_lookup('result', False)
+            return None
+        entry['last_used'] = time.time()
+        _save_result_cache(entries)
+    record_cache_lookup('result', True)
+    logger.info(f"复用已有的处理结果: {entry['files']}")
+    return dict(entry['response'], cached=True)
+
+
+def store_cached_result(cache_key, response_data, files, recipe=None, parts=None):
+    """记录处理结果，并在超出磁盘上限时删除最久未使用的结果文件
+
+    recipe和parts记录重新筛选所需的参数及每个文件对应的数据部分，
+    用于在首次下载时生成尚未写出的文件。
+    """
+    try:
+        with _result_cache_lock:
+            entries = _load_result_cache()
+            entry = {
+                'response': response_data,
+                'files': files,
+                'result_id': response_data.get('result_id'),
+                'recipe': recipe,
+                'parts': parts or {},
+                'last_used': time.time()
+            }
+            entry['size'] = _entry_size(entry)
+            entries[cache_key] = entry
+            _evict_cached_results(entries, keep_key=cache_key)
+            _save_result_cache(entries)
+    except Exception as e:
+        logger.error(f"保存处理结果缓存时出错: {e}")
+
+
+def _evict_cached_results(entries, keep_key):
+    max_size = RESULT_CACHE_MAX_MB * 1024 * 1024
+    total_size = sum(entry['size'] for entry in entries.values())
+    for key in sorted(entries, key=lambda k: entries[k]['last_used']):
+        if total_size <= max_size:
+            break
+        if key == keep_key:
+            continue
+        evicted = entries.pop(key)
+        total_size -= evicted['size']
+        for name in evicted['files']:
+            if os.path.exists(_output_path(name)):
+                os.remove(_output_path(name))
+        logger.info(f"清理最久未使用的处理结果: {evicted['files']}")
+
+
+def find_cached_result(result_id=None, filename=None):
+    """按结果编号或文件名查找处理结果，返回 (缓存键, 记录)"""
+    with _result_cache_lock:
+        for cache_key, entry in _load_result_cache().items():
+            if result_id is not None and entry.get('result_id') == result_id:
+                return cache_key, entry
+            if filename is not None and filename in entry['files']:
+                return cache_key, entry
+    return None, None
+
+
+def refresh_cached_result(cache_key):
+    """结果文件生成后更新占用大小，必要时清理其他结果"""
+    with _result_cache_lock:
+        entries = _load_result_cache()
+        entry = entries.get(cache_key)
+        if entry is None:
+            return
+        entry['size'] = _entry_size(entry)
+        entry['last_used'] = time.time()
+        _evict_cached_results(entries, keep_key=cache_key)
+        _save_result_cache(entries)
+
+
+def cached_output_paths():
+    """处理结果中登记的所有输出文件路径（包括尚未生成的）"""
+    with _result_cache_lock:
+        return {_output_path(name) for entry in _load_result_cache().values() for name in entry['files']}
+
+
+# ========== 延迟生成输出文件 ==========
+
+def _result_frames_nbytes(frames):
+    return sum(_dataframe_nbytes(df) for df in frames['parts'].values())
+
+
+_result_frames = SizedLRUCache(RESULT_FRAMES_MAX_MB * 1024 * 1024, _result_frames_nbytes)
+_materialize_locks = KeyedLocks()
+
+
+def compute_college_split(recipe):
+    """按参数筛选所选学院（一个或多个学院合并筛选）
+
+    返回 (学院数据, 剩余数据, 原始记录数, 删除的重复数, 模板文件, 错误信息)
+    """
+    main_file_path = recipe['main_file_path']
+    check_file_path = recipe.get('check_file_path')
+    selected_college = recipe['selected_college']
+    college_column = recipe['college_column']
+
+    if recipe.get('use_deduplication') and check_file_path:
+        logger.info("使用查重模式")
+        result = correct_deduplicate_and_filter(check_file_path, main_file_path, selected_college, college_column,
+                                                recipe.get('dedupe_against_history', False))
+        college_papers, remaining_papers, original_count, removed_count, error_msg = result
+        template_file = check_file_path  # 使用查重文件作为模板
+    else:
+        logger.info("使用普通筛选模式")
+        result = filter_by_college_only(main_file_path, selected_college, college_column)
+        college_papers, remaining_papers, original_count, error_msg = result
+        removed_count = 0
+        template_file = main_file_path  # 使用主文件作为模板
+
+    # 筛选会话中前几轮已提取的学院不再出现在本轮结果中
+    excluded_colleges = recipe.get('excluded_colleges')
+    if excluded_colleges and not error_msg:
+        excluded_mask = college_selection_mask(college_papers, template_file, college_column, excluded_colleges)
+        college_papers = reset_serial_numbers(college_papers[~excluded_mask].copy())
+        excluded_mask = college_selection_mask(remaining_papers, template_file, college_column, excluded_colleges)
+        remaining_papers = reset_serial_numbers(remaining_papers[~excluded_mask].copy())
+    return college_papers, remaining_papers, original_count, removed_count, template_file, error_msg
+
+
+def build_result_parts(recipe, college_papers, remaining_papers):
+    """处理结果的各部分数据：合并的学院数据、剩余数据，按学院输出时另有每个学院的数据"""
+    parts = {'college': college_papers, 'remaining': remaining_papers}
+    if recipe.get('output_mode') == 'per_college':
+        college_values = college_papers[recipe['college_column']]
+        if is_affiliation_column(recipe['college_column']):
+            index = AffiliationIndex(college_values.tolist())
+        for college in college_list(recipe['selected_college']):
+            if is_affiliation_column(recipe['college_column']):
+                papers = college_papers[index.selection_mask([college])]
+            else:
+                papers = college_papers[college_values == college]
+            if len(papers) > 0:
+                parts[f'college:{college}'] = reset_serial_numbers(papers.copy())
+    return parts
+
+
+def get_result_frames(result_id, recipe):
+    """获取处理结果的数据，已被淘汰时按参数重新筛选"""
+    frames = _result_frames.get(result_id)
+    if frames is None and recipe:
+        logger.info(f"处理结果不在内存中，重新筛选: {result_id}")
+        college_papers, remaining_papers, _, _, template_file, error_msg = compute_college_split(recipe)
+        if error_msg:
+            logger.error(f"重新筛选时出错: {error_msg}")
+            return None
+        frames = {'parts': build_result_parts(recipe, college_papers, remaining_papers),
+                  'template_file': template_file}
+        _result_frames.put(result_id, frames)
+    return frames
+
+
+def materialize_output(filename):
+    """首次下载时生成延迟输出的文件，返回文件是否可用"""
+    cache_key, entry = find_cached_result(filename=filename)
+    if entry is None or filename not in entry.get('parts', {}):
+        return False
+
+    with _materialize_locks.hold(filename):
+        output_file = _output_path(filename)
+        if os.path.exists(output_file):
+            return True
+
+        frames = get_result_frames(entry['result_id'], entry['recipe'])
+        if frames is None:
+            return False
+
+        # 先写入临时文件再改名，避免下载到未写完的文件
+        tmp_file = _output_path(f".{uuid.uuid4().hex}.tmp.xlsx")
+        logger.info(f"生成输出文件: {output_file}")
+        success, = write_outputs([(frames['template_file'], frames['parts'][entry['parts'][filename]], tmp_file)])
+        if not success:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return False
+        os.replace(tmp_file, output_file)
+
+    refresh_cached_result(cache_key)
+    return True
+
+
+# ========== 处理流程 ==========
+
+def _processing_params(data):
+    """从请求数据中取出处理参数"""
+    return {
+        'main_file_path': data.get('main_file_path'),
+        'selected_college': data.get('selected_colleges') or data.get('selected_college'),
+        'college_column': data.get('college_column'),
+        'use_deduplication': data.get('use_deduplication', False),
+        'check_file_path': data.get('check_file_path'),
+        'dedupe_against_history': data.get('dedupe_against_history', False),
+        'materialize': data.get('materialize', False),
+        'output_mode': data.get('output_mode', 'merged'),
+    }
+
+
+def _all_colleges_params(params):
+    """按所有学院拆分不需要所选学院，且总是立即生成文件"""
+    params = dict(params)
+    params.pop('selected_college')
+    params.pop('materialize')
+    params.pop('output_mode')
+    return params
+
+
+def _merged_output_name(colleges):
+    """多个学院合并输出时的文件名"""
+    if len(colleges) == 1:
+        return get_safe_filename(colleges[0])
+    if len(colleges) <= 3:
+        return '_'.join(get_safe_filename(college) for college in colleges)
+    return f"{get_safe_filename(colleges[0])}等{len(colleges)}个学院"
+
+
+def run_process_college(main_file_path, selected_college, college_column, use_deduplication=False,
+                        check_file_path=None, dedupe_against_history=False, materialize=False,
+                        output_mode='merged'):
+    """筛选所选学院，返回统计数据和学院文件、剩余文件的文件名
+
+    selected_college可以是多个学院的列表，只读取和查重一次。output_mode为merged时
+    所选学院合并输出一个文件，为per_college时每个学院输出一个文件。
+    输出文件默认在首次下载时才生成，materialize为True时立即生成。
+    """
+    try:
+        colleges = college_list(selected_college)
+        if not colleges or not all(colleges):
+            return {'success': False, 'error': '请选择学院'}
+        if output_mode not in ('merged', 'per_college'):
+            return {'success': False, 'error': f'不支持的输出方式: {output_mode}'}
+        logger.info(f"开始处理学院数据: {'、'.join(map(str, colleges))}")
+
+        # 单个学院合并输出时沿用原来的缓存键
+        cache_college = colleges[0] if len(colleges) == 1 else colleges
+        cache_kind = 'process-college' if output_mode == 'merged' else 'process-college:per_college'
+        cache_key = result_cache_key(cache_kind, main_file_path, check_file_path, cache_college, college_column,
+                                     use_deduplication, dedupe_against_history)
+        cached_response = lookup_cached_result(cache_key)
+        if cached_response is not None:
+            return cached_response
+
+        recipe = {
+            'main_file_path': main_file_path,
+            'selected_college': selected_college,
+            'college_column': college_column,
+            'use_deduplication': use_deduplication,
+            'check_file_path': check_file_path,
+            'dedupe_against_history': dedupe_against_history,
+            'output_mode': output_mode,
+        }
+        if use_chunked_reading(working_file_path(main_file_path, check_file_path, use_deduplication)):
+            return run_chunked_process_college(cache_key, recipe)
+
+        college_papers, remaining_papers, original_count, removed_count, template_file, error_msg = \
+            compute_college_split(recipe)
+        if error_msg:
+            return {'success': False, 'error': error_msg}
+
+        if college_papers is None or len(college_papers) == 0:
+            return {'success': False, 'error': f'未找到属于"{"、".join(map(str, colleges))}"的论文'}
+
+        parts = build_result_parts(recipe, college_papers, remaining_papers)
+        return publish_college_result(cache_key, recipe, parts, template_file, original_count, removed_count,
+                                      materialize)
+
+    except Exception as e:
+        logger.error(f"处理数据时出错: {str(e)}")
+        return {'success': False, 'error': f'处理数据时出错: {str(e)}'}
+
+
+def publish_college_result(cache_key, recipe, parts, template_file, original_count, removed_count,
+                           materialize=False):
+    """登记筛选结果：预留输出文件名、保留数据供预览和下载，返回响应数据"""
+    colleges = college_list(recipe['selected_college'])
+    output_mode = recipe.get('output_mode', 'merged')
+    college_papers = parts['college']
+    remaining_papers = parts['remaining']
+
+    # 预留输出文件名（包括其他结果中尚未生成的文件）
+    reserved = cached_output_paths()
+    output_files = OrderedDict()
+    if output_mode == 'merged':
+        output_files['college'] = get_unique_filename('outputs', _merged_output_name(colleges), ".xlsx", reserved)
+    else:
+        for college in colleges:
+            if f'college:{college}' in parts:
+                output_files[f'college:{college}'] = get_unique_filename(
+                    'outputs', get_safe_filename(college), ".xlsx", reserved)
+    output_files['remaining'] = get_unique_filename('outputs', "剩余数据", ".xlsx", reserved)
+
+    result_id = uuid.uuid4().hex[:16]
+    _result_frames.put(result_id, {'parts': parts, 'template_file': template_file})
+
+    if materialize:
+        for output_file in output_files.values():
+            logger.info(f"创建输出文件: {output_file}")
+
+        # 使用模板并行创建格式化的Excel文件
+        results = write_outputs([(template_file, parts[part], output_file)
+                                 for part, output_file in output_files.items()])
+        if not all(results):
+            logger.error("Excel文件创建失败")
+            return {'success': False, 'error': '处理文件时出错'}
+
+    response_data = {
+        'success': True,
+        'result_id': result_id,
+        'remaining_file': os.path.basename(output_files['remaining']),
+        'college_count': len(college_papers),
+        'remaining_count': len(remaining_papers),
+        'original_count': original_count,
+        'removed_count': removed_count
+    }
+    if output_mode == 'merged':
+        response_data['college_file'] = os.path.basename(output_files['college'])
+    else:
+        response_data['college_files'] = [
+            {'college': part.split(':', 1)[1], 'file': os.path.basename(output_file), 'count': len(parts[part])}
+            for part, output_file in output_files.items() if part != 'remaining'
+        ]
+    if len(colleges) > 1:
+        response_data['selected_colleges'] = colleges
+    logger.info(f"处理成功: {response_data}")
+
+    file_parts = {os.path.basename(output_file): part for part, output_file in output_files.items()}
+    store_cached_result(cache_key, response_data, list(file_parts), recipe=recipe, parts=file_parts)
+    return response_data
+
+
+def run_process_all_colleges(main_file_path, college_column, use_deduplication=False, check_file_path=None,
+                             dedupe_against_history=False):
+    """一次查重后按所有学院拆分数据，返回响应数据"""
+    try:
+        logger.info("开始按所有学院拆分数据")
+
+        cache_key = result_cache_key('process-all-colleges', main_file_path, check_file_path, None, college_column,
+                                     use_deduplication, dedupe_against_history)
+        cached_response = lookup_cached_result(cache_key)
+        if cached_response is not None:
+            return cached_response
+        if use_chunked_reading(working_file_path(main_file_path, check_file_path, use_deduplication)):
+            return run_chunked_process_all_colleges(cache_key, main_file_path, college_column, use_deduplication,
+                                                    check_file_path, dedupe_against_history)
+
+        data_df, original_count, removed_count, template_file, error_msg = load_working_dataset(
+            main_file_path, check_file_path, use_deduplication, dedupe_against_history)
+        if error_msg:
+            return {'success': False, 'error': error_msg}
+        if college_column not in data_df.columns:
+            return {'success': False, 'error': f'找不到学院列: {college_column}'}
+
+        report_progress('filtering')
+        manifest = split_all_colleges(data_df, college_column, template_file, source_file=template_file)
+        if not all(item['success'] for item in manifest):
+            logger.error("部分Excel文件创建失败")
+
+        response_data = {
+            'success': True,
+            'files': manifest,
+            'file_count': sum(1 for item in manifest if item['success']),
+            'original_count': original_count,
+            'removed_count': removed_count
+        }
+        logger.info(f"拆分完成: 共 {len(manifest)} 个文件")
+        if all(item['success'] for item in manifest):
+            store_cached_result(cache_key, response_data, [item['file'] for item in manifest])
+        return response_data
+
+    except Exception as e:
+        logger.error(f"拆分所有学院时出错: {str(e)}")
+        return {'success': False, 'error': f'拆分所有学院时出错: {str(e)}'}
+
+
+# ========== 大文件分批处理 ==========
+
+def use_chunked_reading(file_path):
+    """是否按批读取该文件（超过CHUNKED_MIN_MB的xlsx文件，xls无法以只读模式逐行读取）"""
+    return (CHUNKED_MIN_MB > 0 and bool(file_path) and file_path.endswith('.xlsx')
+            and os.path.getsize(file_path) > CHUNKED_MIN_MB * 1024 * 1024)
+
+
+def working_file_path(main_file_path, check_file_path=None, use_deduplication=False):
+    """待筛选数据所在的文件（查重模式下为查重文件）"""
+    return check_file_path if use_deduplication and check_file_path else main_file_path
+
+
+def read_excel_header(file_path):
+    """以只读模式读取表头（按pandas的规则处理）"""
+    wb = load_workbook(file_path, read_only=True)
+    try:
+        ws = wb.active
+        return _normalize_header(next(ws.iter_rows(max_row=1, values_only=True), ()))
+    finally:
+        wb.close()
+
+
+def read_excel_columns(file_path, columns):
+    """以只读模式扫描xlsx文件，只读取指定的列（不存在的列忽略）"""
+    batches = list(iter_excel_batches(file_path, columns=columns))
+    if not batches:
+        wanted = set(columns)
+        return pd.DataFrame(columns=[name for name in read_excel_header(file_path) if name in wanted])
+    return pd.concat(batches, ignore_index=True) if len(batches) > 1 else batches[0]
+
+
+def iter_excel_batches(file_path, columns=None, batch_rows=None):
+    """以只读模式逐批读取工作表，每批生成一个DataFrame，不构建整张表
+
+    表头按pandas的规则处理，中间的空行保留为空记录、末尾的空行忽略，
+    与read_excel的结果一致。columns指定时只保留这些列（不存在的列忽略）。
+    """
+    batch_rows = batch_rows or CHUNK_ROWS
+    wb = load_workbook(file_path, read_only=True)
+    try:
+        ws = wb.active
+        # 部分导出文件的尺寸信息不准确，按实际内容遍历
+        ws.reset_dimensions()
+        rows = ws.iter_rows(values_only=True)
+        header = _normalize_header(next(rows, ()))
+        if columns is None:
+            positions = list(range(len(header)))
+        else:
+            wanted = set(columns)
+            positions = [idx for idx, name in enumerate(header) if name in wanted]
+        names = [header[idx] for idx in positions]
+        empty_row = (None,) * len(positions)
+
+        batch = []
+        pending_empty = 0
+        for row in rows:
+            if all(value is None or value == '' for value in row):
+                pending_empty += 1
+                continue
+            batch.extend([empty_row] * pending_empty)
+            pending_empty = 0
+            batch.append(tuple(row[idx] if idx < len(row) else None for idx in positions))
+            if len(batch) >= batch_rows:
+                _rows_processed.inc(len(batch), stage='read')
+                yield pd.DataFrame.from_records(batch, columns=names)
+                batch = []
+        if batch:
+            _rows_processed.inc(len(batch), stage='read')
+            yield pd.DataFrame.from_records(batch, columns=names)
+    finally:
+        wb.close()
+
+
+def iter_working_batches(main_file_path, check_file_path=None, use_deduplication=False,
+                         dedupe_against_history=False, columns=None):
+    """分批读取待筛选数据，查重模式下逐批删除主文件（及历史库）已有的WOS编号
+
+    返回 (批次迭代器, 模板文件, 计数)，计数中的original_count、removed_count随批次累加；
+    查重出错时迭代器抛出ValueError。
+    """
+    use_deduplication = bool(use_deduplication and check_file_path)
+    source_file = working_file_path(main_file_path, check_file_path, use_deduplication)
+    if use_deduplication and columns is not None:
+        columns = [WOS_COLUMN] + [col for col in columns if col != WOS_COLUMN]
+    counts = {'original_count': 0, 'removed_count': 0}
+
+    def batches():
+        for batch in iter_excel_batches(source_file, columns):
+            counts['original_count'] += len(batch)
+            if use_deduplication:
+                deduplicated_df, error_msg = deduplicate_by_wos(batch, main_file_path, dedupe_against_history)
+                if error_msg:
+                    raise ValueError(error_msg)
+                counts['removed_count'] += len(batch) - len(deduplicated_df)
+                batch = deduplicated_df
+            report_progress('filtering', rows_read=counts['original_count'])
+            yield batch
+
+    return batches(), source_file, counts
+
+
+def chunked_college_counts(main_file_path, college_column, check_file_path=None, use_deduplication=False,
+                           dedupe_against_history=False):
+    """分批统计各学院的记录数"""
+    batches, _, _ = iter_working_batches(main_file_path, check_file_path, use_deduplication,
+                                         dedupe_against_history, columns=[college_column])
+    totals = {}
+    for batch in batches:
+        if college_column not in batch.columns:
+            raise ValueError(f'找不到学院列: {college_column}')
+        for college, count in college_counts(batch, None, college_column).items():
+            totals[college] = totals.get(college, 0) + count
+    return dict(sorted(totals.items(), key=lambda item: item[1], reverse=True))
+
+
+class _ChunkedOutputs:
+    """分批写出的一组输出文件，先写入临时文件，全部完成后再改为正式文件名"""
+
+    def __init__(self, template_file):
+        self.profile = get_template_profile(template_file)
+        self.writers = OrderedDict()
+        self.row_counts = {}
+        # 已保存到临时文件、等待改名的文件: key -> (临时文件, 正式文件)
+        self.finished = OrderedDict()
+
+    def append(self, key, data_df, create=False):
+        """把一批数据追加到key对应的文件，序号接着该文件已写出的行数"""
+        if len(data_df) == 0 and not create:
+            return
+        writer = self.writers.get(key)
+        if writer is None:
+            writer = self.writers[key] = TemplateSheetWriter(self.profile, len(data_df.columns))
+        if len(data_df) > 0:
+            data_df = reset_serial_numbers(data_df.copy(), start=writer.rows_written + 1)
+            with timed_stage('row_write', rows=len(data_df)):
+                writer.append(data_df)
+        self.row_counts[key] = writer.rows_written
+
+    def count(self, key):
+        return self.row_counts.get(key, 0)
+
+    def finish(self, key, output_file):
+        """把key对应的文件保存到临时文件并释放其工作表，commit时再改为output_file"""
+        writer = self.writers.pop(key)
+        tmp_file = _output_path(f".{uuid.uuid4().hex}.tmp.xlsx")
+        self.finished[key] = (tmp_file, output_file)
+        try:
+            writer.save(tmp_file)
+        finally:
+            writer.discard()
+
+    def commit(self):
+        """把已保存的临时文件改为正式文件名"""
+        while self.finished:
+            _, (tmp_file, output_file) = self.finished.popitem(last=False)
+            os.replace(tmp_file, output_file)
+
+    def close(self):
+        """放弃所有尚未保存或尚未改名的文件"""
+        for writer in self.writers.values():
+            writer.discard()
+        for tmp_file, _ in self.finished.values():
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def save(self, output_files):
+        """保存为output_files（key到文件路径）中的文件"""
+        report_progress('writing')
+        for key, output_file in output_files.items():
+            self.finish(key, output_file)
+        self.commit()
+
+
+class _GroupSpill:
+    """把各组的数据批次依次追加到同一个临时文件，之后逐组读回
+
+    组数很多时（如按地址列的单位拆分）不必为每组同时打开一个输出文件。
+    """
+
+    def __init__(self):
+        self.path = _output_path(f".{uuid.uuid4().hex}.tmp.spill")
+        self.file = open(self.path, 'w+b')
+        # 组 -> 各批次在文件中的起始位置，按首次出现的顺序
+        self.groups = OrderedDict()
+
+    def append(self, key, data_df):
+        if len(data_df) == 0:
+            return
+        self.file.seek(0, os.SEEK_END)
+        self.groups.setdefault(key, []).append(self.file.tell())
+        pickle.dump(data_df, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def frames(self, key):
+        """按追加顺序逐批读回key的数据"""
+        for offset in self.groups.get(key, []):
+            self.file.seek(offset)
+            yield pickle.load(self.file)
+
+    def close(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def run_chunked_process_college(cache_key, recipe):
+    """分批筛选所选学院：逐批查重、筛选并追加写出，返回与run_process_college相同的响应数据
+
+    结果不保留在内存中，输出文件立即生成，不支持分页预览。
+    """
+    colleges = college_list(recipe['selected_college'])
+    college_column = recipe['college_column']
+    output_mode = recipe.get('output_mode', 'merged')
+    logger.info(f"分批处理学院数据: {'、'.join(map(str, colleges))}")
+
+    batches, template_file, counts = iter_working_batches(
+        recipe['main_file_path'], recipe.get('check_file_path'), recipe.get('use_deduplication'),
+        recipe.get('dedupe_against_history', False))
+    if college_column not in read_excel_header(template_file):
+        return {'success': False, 'error': f'找不到学院列: {college_column}'}
+
+    outputs = _ChunkedOutputs(template_file)
+    try:
+        college_count = 0
+        for batch in batches:
+            college_mask = college_selection_mask(batch, None, college_column, colleges)
+            college_papers = batch[college_mask]
+            college_count += len(college_papers)
+            if output_mode == 'merged':
+                outputs.append('college', college_papers, create=True)
+            else:
+                for college in colleges:
+                    outputs.append(f'college:{college}', college_papers[
+                        college_selection_mask(college_papers, None, college_column, college)])
+            outputs.append('remaining', batch[~college_mask], create=True)
+
+        if college_count == 0:
+            return {'success': False, 'error': f'未找到属于"{"、".join(map(str, colleges))}"的论文'}
+
+        reserved = cached_output_paths()
+        output_files = OrderedDict()
+        if output_mode == 'merged':
+            output_files['college'] = get_unique_filename(
+                'outputs', _merged_output_name(colleges), ".xlsx", reserved)
+        else:
+            for college in colleges:
+                if outputs.count(f'college:{college}') > 0:
+                    output_files[f'college:{college}'] = get_unique_filename(
+                        'outputs', get_safe_filename(college), ".xlsx", reserved)
+        output_files['remaining'] = get_unique_filename('outputs', "剩余数据", ".xlsx", reserved)
+        outputs.save(output_files)
+
+        response_data = {
+            'success': True,
+            'result_id': uuid.uuid4().hex[:16],
+            'remaining_file': os.path.basename(output_files['remaining']),
+            'college_count': college_count,
+            'remaining_count': outputs.count('remaining'),
+            'original_count': counts['original_count'],
+            'removed_count': counts['removed_count'],
+            'chunked': True
+        }
+        if output_mode == 'merged':
+            response_data['college_file'] = os.path.basename(output_files['college'])
+        else:
+            response_data['college_files'] = [
+                {'college': part.split(':', 1)[1], 'file': os.path.basename(output_file), 'count': outputs.count(part)}
+                for part, output_file in output_files.items() if part != 'remaining'
+            ]
+        if len(colleges) > 1:
+            response_data['selected_colleges'] = colleges
+        logger.info(f"分批处理成功: {response_data}")
+
+        store_cached_result(cache_key, response_data, [os.path.basename(path) for path in output_files.values()])
+        return response_data
+    finally:
+        batches.close()
+        outputs.close()
+
+
+def run_chunked_process_all_colleges(cache_key, main_file_path, college_column, use_deduplication=False,
+                                     check_file_path=None, dedupe_against_history=False):
+    """分批按所有学院拆分数据，每个学院的文件逐批追加写出，返回与run_process_all_colleges相同的响应数据"""
+    logger.info("分批按所有学院拆分数据")
+    batches, template_file, counts = iter_working_batches(
+        main_file_path, check_file_path, use_deduplication, dedupe_against_history)
+    if college_column not in read_excel_header(template_file):
+        return {'success': False, 'error': f'找不到学院列: {college_column}'}
+
+    # 学院可能有成百上千个，先按学院暂存各批数据，再逐个学院写出，同时只打开一个输出文件
+    outputs = _ChunkedOutputs(template_file)
+    spill = _GroupSpill()
+    try:
+        for batch in batches:
+            for college_name, college_papers in group_by_college(batch, college_column):
+                spill.append(college_name, college_papers)
+
+        # 与一次性拆分一致，没有学院信息的记录排在最后
+        colleges = [college for college in spill.groups if college is not None]
+        if None in spill.groups:
+            colleges.append(None)
+        reserved = cached_output_paths()
+        output_files = OrderedDict()
+        for college_name in colleges:
+            base_name = get_safe_filename(college_name) if college_name is not None else "未分类数据"
+            output_files[college_name] = get_unique_filename('outputs', base_name, ".xlsx", reserved)
+
+        report_progress('writing')
+        for college_name, output_file in output_files.items():
+            for college_papers in spill.frames(college_name):
+                outputs.append(college_name, college_papers)
+            outputs.finish(college_name, output_file)
+        outputs.commit()
+
+        manifest = [{
+            'college': college_name,
+            'file': os.path.basename(output_file),
+            'count': outputs.count(college_name),
+            'success': True
+        } for college_name, output_file in output_files.items()]
+        response_data = {
+            'success': True,
+            'files': manifest,
+            'file_count': len(manifest),
+            'original_count': counts['original_count'],
+            'removed_count': counts['removed_count'],
+            'chunked': True
+        }
+        logger.info(f"分批拆分完成: 共 {len(manifest)} 个文件")
+        store_cached_result(cache_key, response_data, [item['file'] for item in manifest])
+        return response_data
+    finally:
+        batches.close()
+        spill.close()
+        outputs.close()
+
+
+# ========== 筛选会话 ==========
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _purge_idle_sessions_locked(now):
+    for session_id in [sid for sid, session in _sessions.items()
+                       if now - session['last_used'] > SESSION_IDLE_SECONDS]:
+        del _sessions[session_id]
+        logger.info(f"释放空闲的筛选会话: {session_id}")
+
+
+def create_session(main_file_path, college_column, use_deduplication=False, check_file_path=None,
+                   dedupe_against_history=False, excluded_colleges=None):
+    """建立筛选会话：读取并查重一次，之后每轮只从内存中的数据里提取学院
+
+    会话只保存待筛选数据和"尚未提取"的行掩码，提取学院时更新掩码，
+    不再重新读取和查重。返回 (会话, 错误信息)。
+    """
+    if use_chunked_reading(working_file_path(main_file_path, check_file_path, use_deduplication)):
+        return None, f'文件超过 {CHUNKED_MIN_MB:g} MB，不建立筛选会话，按文件分批筛选'
+    data_df, original_count, removed_count, template_file, error_msg = load_working_dataset(
+        main_file_path, check_file_path, use_deduplication, dedupe_against_history)
+    if error_msg:
+        return None, error_msg
+    if college_column not in data_df.columns:
+        return None, f'找不到学院列: {college_column}'
+
+    nbytes = _dataframe_nbytes(data_df)
+    if nbytes > SESSION_MAX_MB * 1024 * 1024:
+        return None, f'数据占用 {nbytes / 1024 / 1024:.0f} MB，超过筛选会话上限 {SESSION_MAX_MB} MB'
+
+    now = time.time()
+    session = {
+        'id': uuid.uuid4().hex,
+        'data_df': data_df,
+        'alive': np.ones(len(data_df), dtype=bool),
+        'template_file': template_file,
+        'college_column': college_column,
+        'original_count': original_count,
+        'removed_count': removed_count,
+        'extracted': [],
+        'recipe': {
+            'main_file_path': main_file_path,
+            'college_column': college_column,
+            'use_deduplication': use_deduplication,
+            'check_file_path': check_file_path,
+            'dedupe_against_history': dedupe_against_history,
+        },
+        'nbytes': nbytes,
+        'last_used': now,
+        'lock': threading.Lock(),
+    }
+    if excluded_colleges:
+        session['alive'] &= ~_session_selection(session, college_list(excluded_colleges))
+        session['extracted'].extend(college_list(excluded_colleges))
+
+    with _sessions_lock:
+        _purge_idle_sessions_locked(now)
+        _sessions[session['id']] = session
+    logger.info(f"建立筛选会话 {session['id']}: {len(data_df)} 条，{nbytes / 1024 / 1024:.1f} MB")
+    return session, None
+
+
+def get_session(session_id):
+    """获取筛选会话并刷新空闲时间，不存在或已过期时返回None"""
+    now = time.time()
+    with _sessions_lock:
+        _purge_idle_sessions_locked(now)
+        session = _sessions.get(session_id)
+        if session is not None:
+            session['last_used'] = now
+        return session
+
+
+def remove_session(session_id):
+    with _sessions_lock:
+        return _sessions.pop(session_id, None) is not None
+
+
+def _session_selection(session, colleges):
+    return college_selection_mask(session['data_df'], session['template_file'], session['college_column'], colleges)
+
+
+def session_summary(session):
+    """会话中尚未提取的记录数和各学院统计"""
+    data_df = session['data_df']
+    alive = session['alive']
+    index = get_college_index(session['template_file'], session['college_column'])
+    if index is not None and index.covers(data_df):
+        stats = index.counts(data_df.index.to_numpy()[alive])
+    else:
+        stats = college_counts(data_df[alive], session['template_file'], session['college_column'])
+    return {
+        'session_id': session['id'],
+        'record_count': int(alive.sum()),
+        'original_count': session['original_count'],
+        'removed_count': session['removed_count'],
+        'extracted': list(session['extracted']),
+        'college_stats': stats,
+    }
+
+
+def extract_from_session(session, selected_college, materialize=False):
+    """从会话数据中提取所选学院，剩余数据留在会话中供下一轮筛选"""
+    with session['lock']:
+        colleges = college_list(selected_college)
+        if not colleges or not all(colleges):
+            return {'success': False, 'error': '请选择学院'}
+
+        data_df = session['data_df']
+        college_mask = _session_selection(session, colleges) & session['alive']
+        if not college_mask.any():
+            return {'success': False, 'error': f'未找到属于"{"、".join(map(str, colleges))}"的论文'}
+
+        recipe = dict(session['recipe'], selected_college=selected_college,
+                      excluded_colleges=list(session['extracted']), output_mode='merged')
+        cache_key = result_cache_key('session', recipe['main_file_path'], recipe['check_file_path'],
+                                     {'selected': colleges, 'excluded': recipe['excluded_colleges']},
+                                     recipe['college_column'], recipe['use_deduplication'],
+                                     recipe['dedupe_against_history'])
+
+        # 结果成功生成后才从会话中移除所选学院，失败时可以重试
+        remaining_mask = session['alive'] & ~college_mask
+        response_data = lookup_cached_result(cache_key)
+        if response_data is None:
+            college_papers = reset_serial_numbers(data_df[college_mask].copy())
+            remaining_papers = reset_serial_numbers(data_df[remaining_mask].copy())
+            logger.info(f"会话 {session['id']} 提取 {len(college_papers)} 条，剩余 {len(remaining_papers)} 条")
+            parts = {'college': college_papers, 'remaining': remaining_papers}
+            response_data = publish_college_result(cache_key, recipe, parts, session['template_file'],
+                                                   session['original_count'], session['removed_count'],
+                                                   materialize)
+        if response_data.get('success'):
+            session['alive'] = remaining_mask
+            session['extracted'].extend(colleges)
+        return dict(response_data, session_id=session['id'], session_record_count=int(session['alive'].sum()))
+
+
+# ========== 打包下载 ==========
+
+# 单个ZIP（不含ZIP64扩展）能容纳的最大字节数
+BUNDLE_MAX_BYTES = 0xFFFFFFFF
+
+_bundle_crc_cache = SizedLRUCache(4096, lambda crc: 1)
+
+
+def _file_crc32(file_path, signature):
+    """计算文件的CRC32，同一文件只计算一次"""
+    crc = _bundle_crc_cache.get(signature)
+    if crc is None:
+        crc = 0
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                crc = zlib.crc32(chunk, crc)
+        _bundle_crc_cache.put(signature, crc)
+    return crc
+
+
+def _dos_datetime(timestamp):
+    t = time.localtime(max(timestamp, 315532800))  # ZIP时间从1980年开始
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+def plan_bundle(filenames):
+    """规划不压缩（STORED）的ZIP包结构
+
+    xlsx本身已经是压缩文件，原样存入即可。各部分的大小和CRC事先算好，
+    整个包的长度和每个字节的位置都是确定的，因此可以按Range续传。
+    返回 (分段列表, 总长度, ETag)，分段为bytes或 (文件路径, 长度)。
+    """
+    segments = []
+    central_directory = []
+    offset = 0
+    etag_hash = hashlib.sha1()
+
+    for name in filenames:
+        file_path = _output_path(name)
+        stat = os.stat(file_path)
+        signature = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        crc = _file_crc32(file_path, signature)
+        dos_time, dos_date = _dos_datetime(stat.st_mtime)
+        name_bytes = name.encode('utf-8')
+
+        # 标志位0x0800表示文件名为UTF-8编码
+        local_header = struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 20, 0x0800, 0, dos_time, dos_date,
+            crc, stat.st_size, stat.st_size, len(name_bytes), 0
+        ) + name_bytes
+        central_directory.append(struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, 0x0800, 0, dos_time, dos_date,
+            crc, stat.st_size, stat.st_size, len(name_bytes), 0, 0, 0, 0, 0, offset
+        ) + name_bytes)
+
+        segments.append(local_header)
+        segments.append((file_path, stat.st_size))
+        offset += len(local_header) + stat.st_size
+        etag_hash.update(f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\0{crc}\n".encode('utf-8'))
+
+    central_bytes = b''.join(central_directory)
+    end_record = struct.pack(
+        '<IHHHHIIH', 0x06054b50, 0, 0, len(filenames), len(filenames),
+        len(central_bytes), offset, 0
+    )
+    segments.append(central_bytes + end_record)
+    total_size = offset + len(central_bytes) + len(end_record)
+    return segments, total_size, etag_hash.hexdigest()
+
+
+def iter_bundle(segments, start, stop):
+    """按字节区间 [start, stop) 逐块输出ZIP包内容"""
+    offset = 0
+    for segment in segments:
+        segment_size = len(segment) if isinstance(segment, bytes) else segment[1]
+        segment_start = offset
+        offset += segment_size
+        if offset <= start:
+            continue
+        if segment_start >= stop:
+            break
+        low = max(start, segment_start) - segment_start
+        high = min(stop, offset) - segment_start
+        if isinstance(segment, bytes):
+            yield segment[low:high]
+            continue
+        with open(segment[0], 'rb') as f:
+            f.seek(low)
+            remaining = high - low
+            while remaining > 0:
+                chunk = f.read(min(1024 * 1024, remaining))
+                if not chunk:
+                    raise IOError(f"文件在下载过程中被修改: {segment[0]}")
+                remaining -= len(chunk)
+                yield chunk
+
+
+def bundle_files_for(job_id=None, result_id=None, filenames=None):
+    """确定要打包的文件名：任务的输出、处理结果的输出或直接指定的文件"""
+    if job_id:
+        job = get_job(job_id)
+        if job is None or not job['result']:
+            return None, f'任务不存在或尚未完成: {job_id}'
+        result = job['result']
+    elif result_id:
+        _, entry = find_cached_result(result_id=result_id)
+        if entry is None:
+            return None, f'处理结果不存在: {result_id}'
+        result = entry['response']
+    else:
+        return list(OrderedDict.fromkeys(filenames or [])), None
+
+    if 'files' in result:
+        return [item['file'] for item in result['files'] if item.get('success')], None
+    filenames = [item['file'] for item in result.get('college_files', [])]
+    return filenames + [name for name in (result.get('college_file'), result.get('remaining_file')) if name], None
+
+
 # ========== Flask 路由 ==========
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.trace_id = None
+    if DEBUG_TRACE_ENABLED and (request.headers.get('X-Debug-Trace') == '1' or request.args.get('debug_trace') == '1'):
+        g.trace_id = start_trace(request.method, request.path)
+
+
+@app.after_request
+def record_request_metrics(response):
+    """按路由记录接口耗时和请求数，未匹配路由的请求不记录"""
+    started = g.get('request_started')
+    if started is not None and request.url_rule is not None:
+        endpoint = request.url_rule.rule
+        _http_request_duration.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+        _http_requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+
+@app.after_request
+def finish_request_trace(response):
+    """结束请求追踪，响应头X-Trace-Id为追踪编号（流式响应体的生成不计入）"""
+    if g.get('trace_id') and trace_active():
+        finish_trace(response.status_code)
+        response.headers['X-Trace-Id'] = g.trace_id
+    return response
+
+
+@app.teardown_request
+def abandon_request_trace(error=None):
+    """请求异常中断时也要结束追踪"""
+    if trace_active():
+        finish_trace(500)
+
+
 @app.route('/')
 def index():
     """主页面"""
@@ -652,6 +3629,20 @@ def index():
             }
 
             .loading { background: #d4edfc; color: #004085; }
+
+            .progress-bar {
+                height: 8px;
+                background: #ffffff;
+                border-radius: 4px;
+                margin-top: 8px;
+                overflow: hidden;
+            }
+
+            .progress-fill {
+                height: 100%;
+                background: linear-gradient(135deg, #3498db, #2980b9);
+                transition: width 0.3s ease;
+            }
             .error { background: #f8d7da; color: #721c24; }
             .success { background: #d4edda; color: #155724; }
 
@@ -660,6 +3651,35 @@ def index():
                 margin: 25px 0;
             }
 
+            .preview-table-wrapper {
+                overflow-x: auto;
+                max-height: 400px;
+                margin-top: 15px;
+                background: white;
+                border-radius: 10px;
+            }
+
+            .preview-table {
+                border-collapse: collapse;
+                font-size: 0.85em;
+                text-align: left;
+            }
+
+            .preview-table th, .preview-table td {
+                border: 1px solid #ddd;
+                padding: 6px 8px;
+                white-space: nowrap;
+                max-width: 300px;
+                overflow: hidden;
+                text-overflow: ellipsis;
+            }
+
+            .preview-table th {
+                background: #e8f6ff;
+                position: sticky;
+                top: 0;
+            }
+
             .stats {
                 display: grid;
                 grid-template-columns: repeat(auto-fit, minmax(180px, 1fr));
@@ -751,6 +3771,17 @@ def index():
                         <div id="collegeList" class="college-list"></div>
                         <div style="text-align: center; margin-top: 20px;">
                             <button id="processCollegeBtn" class="button process" disabled>开始筛选</button>
+                            <button id="processAllCollegesBtn" class="button continue">一键拆分所有学院</button>
+                        </div>
+                    </div>
+
+                    <!-- 拆分所有学院结果 -->
+                    <div id="splitResultSection" class="result-section hidden">
+                        <h2>✅ 拆分完成！</h2>
+                        <div id="splitResultStats" class="stats"></div>
+                        <div id="splitResultList" class="college-list"></div>
+                        <div style="text-align: center; margin-top: 25px;">
+                            <button id="downloadBundleBtn" class="button download">打包下载全部文件</button>
                         </div>
                     </div>
 
@@ -763,6 +3794,20 @@ def index():
                             <button id="downloadRemainingBtn" class="button download">下载剩余论文表格</button>
                             <button id="continueFilterBtn" class="button continue">继续筛选剩余数据</button>
                         </div>
+                        <div style="text-align: center; margin-top: 15px;">
+                            <button id="previewCollegeBtn" class="button">预览筛选出的论文</button>
+                            <button id="previewRemainingBtn" class="button">预览剩余论文</button>
+                        </div>
+                        <div id="previewSection" class="hidden">
+                            <div class="preview-table-wrapper">
+                                <table id="previewTable" class="preview-table"></table>
+                            </div>
+                            <div style="text-align: center; margin-top: 10px;">
+                                <button id="previewPrevBtn" class="button">上一页</button>
+                                <span id="previewPageInfo"></span>
+                                <button id="previewNextBtn" class="button">下一页</button>
+                            </div>
+                        </div>
                     </div>
                 </div>
 
@@ -783,6 +3828,7 @@ def index():
             let useDeduplication = false;
             let selectedCollegesHistory = [];
             let cumulativeCollegeStats = {};
+            let filterSessionId = null;
 
             // 初始化
             document.addEventListener('DOMContentLoaded', function() {
@@ -791,9 +3837,14 @@ def index():
                 document.getElementById('mainFileInput').addEventListener('change', handleMainFileUpload);
                 document.getElementById('checkFileInput').addEventListener('change', handleCheckFileUpload);
                 document.getElementById('processCollegeBtn').addEventListener('click', processCollegeData);
+                document.getElementById('processAllCollegesBtn').addEventListener('click', processAllColleges);
                 document.getElementById('downloadCollegeBtn').addEventListener('click', downloadCollegeFile);
                 document.getElementById('downloadRemainingBtn').addEventListener('click', downloadRemainingFile);
                 document.getElementById('continueFilterBtn').addEventListener('click', continueFiltering);
+                document.getElementById('previewCollegeBtn').addEventListener('click', () => loadPreview('college', 1));
+                document.getElementById('previewRemainingBtn').addEventListener('click', () => loadPreview('remaining', 1));
+                document.getElementById('previewPrevBtn').addEventListener('click', () => loadPreview(previewState.part, previewState.page - 1));
+                document.getElementById('previewNextBtn').addEventListener('click', () => loadPreview(previewState.part, previewState.page + 1));
             });
 
             // 切换查重模式
@@ -811,6 +3862,7 @@ def index():
                 }
 
                 // 重置状态
+                resetFilterSession();
                 currentFiles.checkFile = null;
                 document.getElementById('checkFileInfo').classList.add('hidden');
                 document.getElementById('checkFileInfo').innerHTML = '';
@@ -848,6 +3900,7 @@ def index():
                 .then(response => response.json())
                 .then(result => {
                     if (result.success) {
+                        resetFilterSession();
                         currentFiles[fileType] = result;
                         displayFileInfo(fileType, result);
 
@@ -855,6 +3908,7 @@ def index():
                             document.getElementById('mainFileUploadSection').classList.add('hidden');
                             updateCurrentFileInfo();
                             cumulativeCollegeStats = {};
+                            selectedCollegesHistory = [];
                         }
 
                         checkProcessingReadyState();
@@ -935,6 +3989,27 @@ def index():
 
                 showMessage('正在统计各学院论文数量...', 'loading');
 
+                // 筛选会话中直接统计尚未提取的数据，会话过期时退回按文件统计
+                if (filterSessionId) {
+                    fetch(`/sessions/${filterSessionId}`)
+                    .then(response => response.json())
+                    .then(result => {
+                        if (result.success) {
+                            collegeStatistics = result.college_stats;
+                            displayCollegeList(result.college_stats);
+                            showMessage('学院统计完成！', 'success');
+                        } else {
+                            filterSessionId = null;
+                            getCollegeStatistics();
+                        }
+                    })
+                    .catch(() => {
+                        filterSessionId = null;
+                        getCollegeStatistics();
+                    });
+                    return;
+                }
+
                 const requestData = {
                     main_file_path: currentFiles.mainFile.file_path,
                     college_column: currentFiles.mainFile.college_column,
@@ -1049,12 +4124,7 @@ def index():
                     requestData.check_file_path = currentFiles.checkFile.file_path;
                 }
 
-                fetch('/process-college', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify(requestData)
-                })
-                .then(response => response.json())
+                extractCollege(requestData)
                 .then(result => {
                     if (result.success) {
                         currentResult = result;
@@ -1074,6 +4144,205 @@ def index():
                 });
             }
 
+            // 有筛选会话时从会话的剩余数据中提取，否则按文件筛选
+            function extractCollege(requestData) {
+                if (!filterSessionId) {
+                    return runJob('process-college', requestData, '正在筛选数据');
+                }
+                return fetch(`/sessions/${filterSessionId}/extract`, {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({selected_college: requestData.selected_college})
+                })
+                .then(response => {
+                    if (response.status === 404) {
+                        filterSessionId = null;
+                        return runJob('process-college', requestData, '正在筛选数据');
+                    }
+                    return response.json();
+                });
+            }
+
+            // 结束筛选会话（文件或模式变化后旧会话不再适用）
+            function resetFilterSession() {
+                if (filterSessionId) {
+                    fetch(`/sessions/${filterSessionId}`, { method: 'DELETE' }).catch(() => {});
+                }
+                filterSessionId = null;
+            }
+
+            // 一键拆分所有学院
+            function processAllColleges() {
+                if (!currentFiles.mainFile) return;
+
+                showMessage('正在按所有学院拆分数据，请稍候...', 'loading');
+
+                const requestData = {
+                    main_file_path: currentFiles.mainFile.file_path,
+                    college_column: currentFiles.mainFile.college_column,
+                    use_deduplication: useDeduplication
+                };
+
+                if (useDeduplication && currentFiles.checkFile) {
+                    requestData.check_file_path = currentFiles.checkFile.file_path;
+                }
+
+                runJob('process-all-colleges', requestData, '正在按所有学院拆分数据')
+                .then(result => {
+                    if (result.success) {
+                        showSplitResults(result);
+                        showMessage('拆分完成！', 'success');
+                    } else {
+                        showMessage(result.error, 'error');
+                    }
+                })
+                .catch(error => {
+                    showMessage('拆分数据时出错: ' + error.message, 'error');
+                });
+            }
+
+            // 显示拆分结果
+            function showSplitResults(result) {
+                let statsHTML = `
+                    <div class="stat-item">
+                        <div class="stat-number">${result.original_count}</div>
+                        <div>${useDeduplication ? '查重文件' : '原始'}论文数</div>
+                    </div>
+                    <div class="stat-item">
+                        <div class="stat-number" style="color: #27ae60">${result.file_count}</div>
+                        <div>生成文件数</div>
+                    </div>
+                `;
+                if (useDeduplication) {
+                    statsHTML += `
+                        <div class="stat-item">
+                            <div class="stat-number">${result.removed_count}</div>
+                            <div>删除重复数</div>
+                        </div>
+                    `;
+                }
+                document.getElementById('splitResultStats').innerHTML = statsHTML;
+
+                const listDiv = document.getElementById('splitResultList');
+                listDiv.innerHTML = '';
+                for (const item of result.files) {
+                    const collegeName = item.college === null ? '未分类数据' : item.college;
+                    const itemDiv = document.createElement('div');
+                    itemDiv.className = 'college-item';
+                    itemDiv.innerHTML = `
+                        <div style="font-size: 1.1em; font-weight: bold; margin-bottom: 5px;">${collegeName}</div>
+                        <div style="font-size: 0.85em; color: #666;">${item.success ? item.count + ' 篇' : '生成失败'}</div>
+                    `;
+                    if (item.success) {
+                        itemDiv.onclick = () => downloadFile(item.file, collegeName + '文件');
+                    }
+                    listDiv.appendChild(itemDiv);
+                }
+                const bundleFiles = result.files.filter(item => item.success).map(item => item.file);
+                document.getElementById('downloadBundleBtn').onclick = () => {
+                    const link = document.createElement('a');
+                    link.href = '/download-bundle?' + bundleFiles.map(name => 'file=' + encodeURIComponent(name)).join('&');
+                    link.style.display = 'none';
+                    document.body.appendChild(link);
+                    link.click();
+                    document.body.removeChild(link);
+                    showMessage('开始打包下载...', 'success');
+                };
+                document.getElementById('splitResultSection').classList.remove('hidden');
+            }
+
+            // 处理阶段名称
+            const jobStageLabels = {
+                queued: '排队中',
+                reading: '读取文件',
+                deduplicating: '查重',
+                filtering: '筛选',
+                writing: '生成表格',
+                done: '完成'
+            };
+
+            // 提交后台任务并轮询进度，返回任务结果
+            function runJob(jobType, requestData, loadingText) {
+                return fetch('/jobs', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify(Object.assign({type: jobType}, requestData))
+                })
+                .then(response => response.json())
+                .then(submitted => {
+                    if (!submitted.success) return submitted;
+                    return watchJob(submitted.job_id, loadingText);
+                });
+            }
+
+            // 通过事件流接收任务进度，不支持时退回轮询
+            function watchJob(jobId, loadingText) {
+                if (!window.EventSource) return pollJob(jobId, loadingText);
+
+                return new Promise(resolve => {
+                    const source = new EventSource(`/jobs/${jobId}/events`);
+                    let lastStage = 'queued';
+                    let lastPercent = 0;
+                    const finish = event => {
+                        source.close();
+                        resolve(JSON.parse(event.data));
+                    };
+
+                    source.addEventListener('progress', event => {
+                        const data = JSON.parse(event.data);
+                        lastStage = data.stage;
+                        lastPercent = data.percent;
+                        showProgress(loadingText, lastStage, lastPercent, '');
+                    });
+                    source.addEventListener('rows', event => {
+                        const data = JSON.parse(event.data);
+                        showProgress(loadingText, lastStage, lastPercent,
+                            `${data.file}: 已写入 ${data.rows_written}/${data.total_rows} 行`);
+                    });
+                    source.addEventListener('done', finish);
+                    source.addEventListener('failed', finish);
+                    source.onerror = () => {
+                        // 浏览器会自动携带Last-Event-ID重连，连接被彻底关闭时改用轮询
+                        if (source.readyState === EventSource.CLOSED) {
+                            resolve(pollJob(jobId, loadingText));
+                        }
+                    };
+                });
+            }
+
+            // 显示带进度条的处理状态
+            function showProgress(loadingText, stage, percent, detail) {
+                showMessage(`
+                    ${loadingText}（${jobStageLabels[stage] || stage} ${percent}%）
+                    ${detail ? `<div style="font-weight: normal; font-size: 0.9em;">${detail}</div>` : ''}
+                    <div class="progress-bar"><div class="progress-fill" style="width: ${percent}%"></div></div>
+                `, 'loading');
+            }
+
+            function pollJob(jobId, loadingText) {
+                return new Promise((resolve, reject) => {
+                    const poll = () => {
+                        fetch(`/jobs/${jobId}`)
+                        .then(response => response.json())
+                        .then(status => {
+                            if (!status.success) {
+                                resolve(status);
+                                return;
+                            }
+                            const job = status.job;
+                            if (job.status === 'finished' || job.status === 'failed') {
+                                resolve(job.result || {success: false, error: job.error});
+                                return;
+                            }
+                            showProgress(loadingText, job.stage, job.percent, '');
+                            setTimeout(poll, 1000);
+                        })
+                        .catch(reject);
+                    };
+                    poll();
+                });
+            }
+
             // 显示结果
             function showResults(result) {
                 const statsDiv = document.getElementById('resultStats');
@@ -1115,9 +4384,52 @@ def index():
                 `;
 
                 statsDiv.innerHTML = statsHTML;
+                document.getElementById('previewSection').classList.add('hidden');
                 document.getElementById('resultSection').classList.remove('hidden');
             }
 
+            // 预览结果（文件在下载时才生成）
+            const PREVIEW_PAGE_SIZE = 20;
+            let previewState = { part: 'college', page: 1, totalPages: 1 };
+
+            function escapeHtml(value) {
+                if (value === null || value === undefined) return '';
+                return String(value).replace(/[&<>"']/g, ch => ({
+                    '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+                })[ch]);
+            }
+
+            async function loadPreview(part, page) {
+                if (!currentResult || !currentResult.result_id) {
+                    showMessage('没有可预览的结果', 'error');
+                    return;
+                }
+                if (page < 1 || (part === previewState.part && page > previewState.totalPages)) return;
+
+                try {
+                    const response = await fetch(
+                        `/results/${currentResult.result_id}/preview?part=${part}&page=${page}&page_size=${PREVIEW_PAGE_SIZE}`
+                    );
+                    const result = await response.json();
+                    if (!result.success) {
+                        showMessage(result.error, 'error');
+                        return;
+                    }
+
+                    previewState = { part: part, page: result.page, totalPages: Math.max(result.total_pages, 1) };
+                    let tableHTML = '<tr>' + result.columns.map(col => `<th>${escapeHtml(col)}</th>`).join('') + '</tr>';
+                    result.rows.forEach(row => {
+                        tableHTML += '<tr>' + row.map(value => `<td>${escapeHtml(value)}</td>`).join('') + '</tr>';
+                    });
+                    document.getElementById('previewTable').innerHTML = tableHTML;
+                    document.getElementById('previewPageInfo').textContent =
+                        `第 ${previewState.page} / ${previewState.totalPages} 页，共 ${result.total_rows} 条`;
+                    document.getElementById('previewSection').classList.remove('hidden');
+                } catch (error) {
+                    showMessage('预览失败: ' + error.message, 'error');
+                }
+            }
+
             // 下载文件
             function downloadCollegeFile() {
                 if (!currentResult || !currentResult.college_file) {
@@ -1156,8 +4468,41 @@ def index():
                 document.getElementById('processCollegeBtn').textContent = '开始筛选';
 
                 updateCurrentFileInfo();
-                getCollegeStatistics();
-                showMessage('可以继续筛选下一个学院', 'success');
+                if (filterSessionId) {
+                    getCollegeStatistics();
+                    return;
+                }
+
+                // 首次继续筛选时建立会话：只读取和查重一次，之后每轮从内存中的剩余数据提取
+                showMessage('正在准备剩余数据...', 'loading');
+                const requestData = {
+                    main_file_path: currentFiles.mainFile.file_path,
+                    college_column: currentFiles.mainFile.college_column,
+                    use_deduplication: useDeduplication,
+                    excluded_colleges: selectedCollegesHistory
+                };
+                if (useDeduplication && currentFiles.checkFile) {
+                    requestData.check_file_path = currentFiles.checkFile.file_path;
+                }
+
+                fetch('/sessions', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify(requestData)
+                })
+                .then(response => response.json())
+                .then(result => {
+                    if (result.success) {
+                        filterSessionId = result.session_id;
+                        collegeStatistics = result.college_stats;
+                        displayCollegeList(result.college_stats);
+                        showMessage('可以继续筛选下一个学院', 'success');
+                    } else {
+                        // 数据过大等情况下退回按文件筛选
+                        getCollegeStatistics();
+                    }
+                })
+                .catch(() => getCollegeStatistics());
             }
 
             // 显示消息
@@ -1194,25 +4539,37 @@ def upload_file():
         return jsonify({'success': False, 'error': '请上传Excel文件'})
 
     try:
-        # 保存文件
-        os.makedirs('uploads', exist_ok=True)
-        file_path = os.path.join('uploads', file.filename)
-        file.save(file_path)
+        # 按内容哈希保存文件，相同内容只保存一份
+        file_path, content_hash = save_upload_by_hash(file.stream, file.filename)
 
-        # 读取Excel文件
-        df = pd.read_excel(file_path)
-
-        # 获取学院信息
-        colleges, college_column = get_colleges_from_data(df)
+        summary = load_upload_summary(content_hash)
+        record_cache_lookup('upload_summary', summary is not None)
+        if summary is not None:
+            logger.info(f"文件已上传过，复用解析结果: {file.filename} ({content_hash[:12]})")
+        else:
+            # 流式扫描得到记录数和学院信息
+            summary = summarize_workbook(file_path)
+            save_upload_summary(content_hash, summary)
+
+        # 后台预先解析，供后续统计和筛选使用：小文件整表解析并生成列式副本；
+        # 较大的文件一次扫描出WOS列和学院列，学院统计、查重和WOS编号登记都从中投影；
+        # 分批处理的大文件不预先读取
+        if not use_chunked_reading(file_path):
+            if os.path.getsize(file_path) <= WARM_FULL_MAX_MB * 1024 * 1024:
+                _sidecar_executor.submit(warm_dataframe_cache, file_path)
+            else:
+                columns = [WOS_COLUMN] + ([summary['college_column']] if summary['college_column'] else [])
+                _sidecar_executor.submit(warm_dataframe_cache, file_path, columns)
 
         response_data = {
             'success': True,
             'filename': file.filename,
             'file_path': file_path,
-            'record_count': len(df),
-            'colleges': colleges,
-            'college_column': college_column,
-            'has_wos': 'WOS Accession Number' in df.columns
+            'content_hash': content_hash,
+            'record_count': summary['record_count'],
+            'colleges': summary['colleges'],
+            'college_column': summary['college_column'],
+            'has_wos': summary['has_wos']
         }
 
         return jsonify(response_data)
@@ -1230,13 +4587,18 @@ def get_college_stats():
     college_column = data.get('college_column')
     use_deduplication = data.get('use_deduplication', False)
     check_file_path = data.get('check_file_path')
+    dedupe_against_history = data.get('dedupe_against_history', False)
 
     try:
-        if use_deduplication and check_file_path:
-            college_stats = get_correct_deduplicated_stats(check_file_path, main_file_path, college_column)
+        if use_chunked_reading(working_file_path(main_file_path, check_file_path, use_deduplication)):
+            college_stats = chunked_college_counts(main_file_path, college_column, check_file_path,
+                                                   use_deduplication, dedupe_against_history)
+        elif use_deduplication and check_file_path:
+            college_stats = get_correct_deduplicated_stats(check_file_path, main_file_path, college_column,
+                                                           dedupe_against_history)
         else:
-            df = pd.read_excel(main_file_path)
-            college_stats = df[college_column].value_counts().to_dict()
+            df = read_excel_cached(main_file_path, columns=[college_column])
+            college_stats = college_counts(df, main_file_path, college_column)
 
         return jsonify({
             'success': True,
@@ -1251,82 +4613,249 @@ def get_college_stats():
 @app.route('/process-college', methods=['POST'])
 def process_college_data():
     """处理学院数据筛选"""
+    return jsonify(run_process_college(**_processing_params(request.json)))
+
+
+@app.route('/process-all-colleges', methods=['POST'])
+def process_all_colleges():
+    """一次查重后按所有学院拆分数据"""
+    params = _all_colleges_params(_processing_params(request.json))
+    return jsonify(run_process_all_colleges(**params))
+
+
+# 可提交为后台任务的处理类型
+JOB_TYPES = {
+    'process-college': run_process_college,
+    'process-all-colleges': run_process_all_colleges,
+}
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """提交后台处理任务，立即返回任务编号"""
     data = request.json
-    main_file_path = data.get('main_file_path')
-    selected_college = data.get('selected_college')
-    college_column = data.get('college_column')
-    use_deduplication = data.get('use_deduplication', False)
-    check_file_path = data.get('check_file_path')
+    job_type = data.get('type', 'process-college')
+    if job_type not in JOB_TYPES:
+        return jsonify({'success': False, 'error': f'不支持的任务类型: {job_type}'}), 400
+
+    params = _processing_params(data)
+    if job_type == 'process-all-colleges':
+        params = _all_colleges_params(params)
+    job_id = submit_job(job_type, JOB_TYPES[job_type], params)
+    return jsonify({'success': True, 'job_id': job_id})
+
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """查询后台任务的阶段和进度"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': f'任务不存在: {job_id}'}), 404
+    return jsonify({'success': True, 'job': job})
+
+
+@app.route('/sessions', methods=['POST'])
+def create_filter_session():
+    """建立"继续筛选"会话，excluded_colleges为已经提取过的学院"""
+    data = request.json
+    params = _all_colleges_params(_processing_params(data))
     try:
-        logger.info(f"开始处理学院数据: {selected_college}")
-
-        if use_deduplication and check_file_path:
-            logger.info("使用查重模式")
-            result = correct_deduplicate_and_filter(check_file_path, main_file_path, selected_college, college_column)
-            if result[4] is not None:  # 错误信息
-                return jsonify({'success': False, 'error': result[4]})
-            college_papers, remaining_papers, original_count, removed_count, _ = result
-            template_file = check_file_path  # 使用查重文件作为模板
-        else:
-            logger.info("使用普通筛选模式")
-            result = filter_by_college_only(main_file_path, selected_college, college_column)
-            college_papers, remaining_papers, original_count, error_msg = result
-            if error_msg:
-                return jsonify({'success': False, 'error': error_msg})
-            removed_count = 0
-            template_file = main_file_path  # 使用主文件作为模板
+        session, error_msg = create_session(excluded_colleges=data.get('excluded_colleges'), **params)
+        if error_msg:
+            return jsonify({'success': False, 'error': error_msg}), 400
+        return jsonify(dict(session_summary(session), success=True))
 
-        if college_papers is None or len(college_papers) == 0:
-            return jsonify({'success': False, 'error': f'未找到属于"{selected_college}"的论文'})
-
-        # 生成输出文件
-        safe_college_name = get_safe_filename(selected_college)
-        college_file = get_unique_filename('outputs', safe_college_name, ".xlsx")
-        remaining_file = get_unique_filename('outputs', "剩余数据", ".xlsx")
-
-        logger.info(f"创建学院文件: {college_file}")
-        logger.info(f"创建剩余文件: {remaining_file}")
-
-        # 使用模板创建格式化的Excel文件
-        success1 = create_exact_copy_from_template(template_file, college_papers, college_file)
-        success2 = create_exact_copy_from_template(template_file, remaining_papers, remaining_file)
-
-        if success1 and success2:
-            response_data = {
-                'success': True,
-                'college_file': os.path.basename(college_file),
-                'remaining_file': os.path.basename(remaining_file),
-                'college_count': len(college_papers),
-                'remaining_count': len(remaining_papers),
-                'original_count': original_count,
-                'removed_count': removed_count
-            }
-            logger.info(f"处理成功: {response_data}")
-            return jsonify(response_data)
-        else:
-            logger.error("Excel文件创建失败")
-            return jsonify({'success': False, 'error': '处理文件时出错'})
+    except Exception as e:
+        logger.error(f"建立筛选会话时出错: {str(e)}")
+        return jsonify({'success': False, 'error': f'建立筛选会话时出错: {str(e)}'}), 500
+
+
+@app.route('/sessions/<session_id>', methods=['GET'])
+def get_filter_session(session_id):
+    """查看会话中剩余数据的学院统计"""
+    session = get_session(session_id)
+    if session is None:
+        return jsonify({'success': False, 'error': f'筛选会话不存在或已过期: {session_id}'}), 404
+    return jsonify(dict(session_summary(session), success=True))
+
+
+@app.route('/sessions/<session_id>/extract', methods=['POST'])
+def extract_filter_session(session_id):
+    """从会话的剩余数据中提取学院"""
+    session = get_session(session_id)
+    if session is None:
+        return jsonify({'success': False, 'error': f'筛选会话不存在或已过期: {session_id}'}), 404
+    data = request.json
+    try:
+        return jsonify(extract_from_session(session, data.get('selected_colleges') or data.get('selected_college'),
+                                            data.get('materialize', False)))
 
     except Exception as e:
-        logger.error(f"处理数据时出错: {str(e)}")
-        return jsonify({'success': False, 'error': f'处理数据时出错: {str(e)}'})
+        logger.error(f"会话筛选时出错: {str(e)}")
+        return jsonify({'success': False, 'error': f'处理数据时出错: {str(e)}'}), 500
+
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+def delete_filter_session(session_id):
+    """结束筛选会话"""
+    if not remove_session(session_id):
+        return jsonify({'success': False, 'error': f'筛选会话不存在或已过期: {session_id}'}), 404
+    return jsonify({'success': True})
+
+
+@app.route('/wos-index', methods=['GET'])
+def wos_index_sources():
+    """列出WOS编号索引中登记的文件"""
+    try:
+        return jsonify({'success': True, 'sources': list_wos_sources()})
+    except Exception as e:
+        logger.error(f"读取WOS编号索引时出错: {str(e)}")
+        return jsonify({'success': False, 'error': f'读取WOS编号索引时出错: {str(e)}'})
+
+
+@app.route('/wos-index', methods=['POST'])
+def wos_index_register():
+    """把已上传的文件登记到历史库"""
+    data = request.json
+    file_path = data.get('file_path')
+    if not file_path or not os.path.exists(file_path):
+        return jsonify({'success': False, 'error': f'文件不存在: {file_path}'})
+
+    try:
+        source_id, error_msg = register_wos_source(file_path, label=data.get('label'), in_library=True)
+        if error_msg:
+            return jsonify({'success': False, 'error': error_msg})
+        return jsonify({'success': True, 'source_id': source_id})
+    except Exception as e:
+        logger.error(f"登记WOS编号时出错: {str(e)}")
+        return jsonify({'success': False, 'error': f'登记WOS编号时出错: {str(e)}'})
+
+
+@app.route('/wos-index/<int:source_id>', methods=['DELETE'])
+def wos_index_remove(source_id):
+    """从WOS编号索引中删除一个文件"""
+    if not remove_wos_source(source_id):
+        return jsonify({'success': False, 'error': f'索引中不存在该文件: {source_id}'}), 404
+    return jsonify({'success': True})
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """以Server-Sent Events推送任务进度，支持Last-Event-ID断点续传"""
+    if get_job(job_id) is None:
+        return jsonify({'success': False, 'error': f'任务不存在: {job_id}'}), 404
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id', '0')
+    last_event_id = int(last_event_id) if last_event_id.isdigit() else 0
+
+    def generate():
+        after_event_id = last_event_id
+        yield 'retry: 2000\n\n'
+        while True:
+            events, finished = wait_job_events(job_id, after_event_id, SSE_KEEPALIVE_SECONDS)
+            if events is None:
+                return
+            for event in events:
+                data = json.dumps(event['data'], ensure_ascii=False, default=str)
+                yield f"id: {event['id']}\nevent: {event['event']}\ndata: {data}\n\n"
+                after_event_id = event['id']
+            if finished and not events:
+                return
+            if not events:
+                yield ': keep-alive\n\n'
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.route('/results/<result_id>/preview')
+def preview_result(result_id):
+    """分页预览处理结果，part为college（学院数据）、remaining（剩余数据）或 college:<学院>"""
+    part = request.args.get('part', 'college')
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        page_size = min(max(int(request.args.get('page_size', 50)), 1), PREVIEW_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'success': False, 'error': '分页参数无效'}), 400
+
+    try:
+        _, entry = find_cached_result(result_id=result_id)
+        frames = get_result_frames(result_id, entry['recipe'] if entry else None)
+        if frames is None:
+            return jsonify({'success': False, 'error': f'处理结果不存在: {result_id}'}), 404
+
+        if part not in frames['parts']:
+            return jsonify({'success': False, 'error': f'不支持的预览内容: {part}'}), 400
+        data_df = frames['parts'][part]
+        total_rows = len(data_df)
+        start = (page - 1) * page_size
+        page_df = data_df.iloc[start:start + page_size]
+        rows = json.loads(page_df.to_json(orient='values', date_format='iso', force_ascii=False))
+
+        return jsonify({
+            'success': True,
+            'part': part,
+            'columns': [str(col) for col in data_df.columns],
+            'rows': rows,
+            'page': page,
+            'page_size': page_size,
+            'total_rows': total_rows,
+            'total_pages': (total_rows + page_size - 1) // page_size
+        })
+
+    except Exception as e:
+        logger.error(f"预览处理结果时出错: {str(e)}")
+        return jsonify({'success': False, 'error': f'预览处理结果时出错: {str(e)}'}), 500
+
+
+def _stream_pending_output(filename):
+    """把尚未生成的输出文件直接流式写入响应，返回None表示无法流式输出"""
+    _, entry = find_cached_result(filename=filename)
+    if entry is None or filename not in entry.get('parts', {}):
+        return None
+    frames = get_result_frames(entry['result_id'], entry['recipe'])
+    if frames is None:
+        return None
+
+    # 响应头发出后无法再报错，模板格式需在开始输出前读取，读取失败时改为生成文件后下载
+    try:
+        profile = get_template_profile(frames['template_file'])
+    except Exception as e:
+        logger.error(f"读取模板格式失败，改为生成文件后下载: {e}")
+        return None
+
+    logger.info(f"流式输出文件: {filename}")
+    data_df = frames['parts'][entry['parts'][filename]]
+    return Response(
+        stream_with_context(stream_xlsx_from_template(frames['template_file'], data_df, profile)),
+        mimetype=XLSX_MIMETYPE,
+        headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}"}
+    )
 
 
 @app.route('/download/<filename>')
 def download_file(filename):
-    """下载处理后的文件"""
+    """下载处理后的文件，stream=1时未生成的文件直接流式输出而不写入磁盘"""
     try:
         file_path = os.path.join('outputs', filename)
 
-        if not os.path.exists(file_path):
+        if not os.path.exists(file_path) and request.args.get('stream') == '1':
+            response = _stream_pending_output(filename)
+            if response is not None:
+                return response
+
+        # 延迟输出的文件在首次下载时生成
+        if not os.path.exists(file_path) and not materialize_output(filename):
             return jsonify({'success': False, 'error': f'文件不存在: {filename}'}), 404
 
         return send_file(
             file_path,
             as_attachment=True,
             download_name=filename,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            mimetype=XLSX_MIMETYPE
         )
 
     except Exception as e:
@@ -1334,10 +4863,159 @@ def download_file(filename):
         return jsonify({'success': False, 'error': f'下载文件时出错: {str(e)}'}), 500
 
 
+@app.route('/download-bundle')
+def download_bundle():
+    """打包下载多个输出文件，支持Range续传
+
+    参数 job_id、result_id 或 files（逗号分隔的文件名，也可重复传入file）三选一。
+    """
+    try:
+        filenames = [name for value in request.args.getlist('files') for name in value.split(',') if name]
+        filenames += request.args.getlist('file')
+        filenames, error_msg = bundle_files_for(
+            job_id=request.args.get('job_id'),
+            result_id=request.args.get('result_id'),
+            filenames=filenames
+        )
+        if error_msg:
+            return jsonify({'success': False, 'error': error_msg}), 404
+        if not filenames:
+            return jsonify({'success': False, 'error': '没有指定要打包的文件'}), 400
+
+        for name in filenames:
+            if os.path.basename(name) != name or name.startswith('.'):
+                return jsonify({'success': False, 'error': f'文件名无效: {name}'}), 400
+            # 延迟输出的文件先生成，才能事先确定包的大小
+            if not os.path.exists(_output_path(name)) and not materialize_output(name):
+                return jsonify({'success': False, 'error': f'文件不存在: {name}'}), 404
+
+        segments, total_size, etag = plan_bundle(filenames)
+        if total_size > BUNDLE_MAX_BYTES:
+            return jsonify({'success': False, 'error': '打包文件超过4GB，请分批下载'}), 413
+
+        download_name = request.args.get('name') or '拆分结果.zip'
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'ETag': f'"{etag}"',
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(download_name)}",
+        }
+
+        # If-Range与当前ETag不一致时（文件已变化）返回完整内容
+        byte_range = request.range
+        if_range = request.if_range
+        if byte_range is not None and (if_range.date is not None or if_range.etag not in (None, etag)):
+            byte_range = None
+
+        start, stop, status = 0, total_size, 200
+        if byte_range is not None:
+            range_bounds = byte_range.range_for_length(total_size)
+            if range_bounds is None:
+                headers['Content-Range'] = f'bytes */{total_size}'
+                return Response(status=416, headers=headers)
+            start, stop = range_bounds
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{total_size}'
+
+        headers['Content-Length'] = str(stop - start)
+        logger.info(f"打包下载 {len(filenames)} 个文件，字节 {start}-{stop - 1}/{total_size}")
+        return Response(
+            stream_with_context(iter_bundle(segments, start, stop)),
+            status=status,
+            mimetype='application/zip',
+            headers=headers
+        )
+
+    except Exception as e:
+        logger.error(f"打包下载时出错: {str(e)}")
+        return jsonify({'success': False, 'error': f'打包下载时出错: {str(e)}'}), 500
+
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus文本格式的性能指标"""
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+TRACE_VIEWER_TEMPLATE = '''<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+    <meta charset="UTF-8">
+    <title>请求追踪</title>
+    <style>
+        body { font-family: Arial, sans-serif; margin: 20px; color: #333; }
+        details { border: 1px solid #ddd; border-radius: 4px; margin-bottom: 10px; padding: 8px 12px; }
+        summary { cursor: pointer; font-weight: bold; }
+        table { border-collapse: collapse; width: 100%; margin-top: 8px; font-size: 13px; }
+        th, td { border-bottom: 1px solid #eee; padding: 4px 6px; text-align: left; white-space: nowrap; }
+        td.num { text-align: right; }
+        .timeline { position: relative; width: 300px; height: 12px; background: #f5f5f5; }
+        .bar { position: absolute; top: 0; height: 12px; background: #4a90d9; min-width: 1px; }
+        .attrs { color: #888; white-space: normal; }
+    </style>
+</head>
+<body>
+    <h1>请求追踪</h1>
+    <p>在请求头加上 <code>X-Debug-Trace: 1</code> 或在地址中加上 <code>debug_trace=1</code> 即记录该请求。
+       内存峰值为区段开始后新增的Python内存峰值，同时追踪多个请求时会互相影响。</p>
+    {% if not traces %}<p>暂无追踪记录。</p>{% endif %}
+    {% for trace in traces %}
+    <details {% if loop.first %}open{% endif %}>
+        <summary>{{ trace.started_at }} {{ trace.name }} → {{ trace.status }}，
+            {{ trace.duration_ms }} ms，内存峰值 {{ trace.peak_mb }} MB，RSS变化 {{ trace.rss_delta_mb }} MB
+            （{{ trace.trace_id }}）</summary>
+        <table>
+            <tr><th>区段</th><th>时间线</th><th>开始(ms)</th><th>耗时(ms)</th><th>内存峰值(MB)</th>
+                <th>内存变化(MB)</th><th>RSS变化(MB)</th><th>参数</th></tr>
+            {% for depth, span in flatten_spans(trace.root) %}
+            <tr>
+                <td style="padding-left: {{ 6 + depth * 18 }}px">{{ span.name }}</td>
+                <td><div class="timeline"><div class="bar" style="left: {{ (span.start_ms / (trace.duration_ms or 1) * 100)|round(2) }}%; width: {{ (span.duration_ms / (trace.duration_ms or 1) * 100)|round(2) }}%"></div></div></td>
+                <td class="num">{{ span.start_ms }}</td>
+                <td class="num">{{ span.duration_ms }}</td>
+                <td class="num">{{ span.peak_mb }}</td>
+                <td class="num">{{ span.memory_delta_mb }}</td>
+                <td class="num">{{ span.rss_delta_mb }}</td>
+                <td class="attrs">{% for key, value in span.attrs.items() %}{{ key }}={{ value }} {% endfor %}</td>
+            </tr>
+            {% endfor %}
+        </table>
+    </details>
+    {% endfor %}
+</body>
+</html>
+'''
+
+
+@app.route('/debug/traces')
+def debug_traces():
+    """查看最近的请求追踪，format=json时返回JSON"""
+    if not DEBUG_TRACE_ENABLED:
+        return jsonify({'success': False, 'error': '请求追踪未启用'}), 404
+    traces = recent_traces()
+    if request.args.get('format') == 'json':
+        return jsonify({'success': True, 'traces': traces})
+    return render_template_string(TRACE_VIEWER_TEMPLATE, traces=traces, flatten_spans=flatten_spans)
+
+
+@app.route('/debug/traces/<trace_id>')
+def debug_trace(trace_id):
+    """获取单个请求追踪"""
+    trace = next((trace for trace in recent_traces() if trace['trace_id'] == trace_id), None)
+    if not DEBUG_TRACE_ENABLED or trace is None:
+        return jsonify({'success': False, 'error': '追踪记录不存在'}), 404
+    return jsonify({'success': True, 'trace': trace})
+
+
 if __name__ == '__main__':
     # 确保输出目录存在
     os.makedirs('outputs', exist_ok=True)
     os.makedirs('uploads', exist_ok=True)
 
+    # 预先启动输出进程。调试模式下重载器的监视进程也会执行这里，只在实际提供服务的进程中启动
+    debug = True
+    if OUTPUT_POOL_SIZE > 0 and (not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        warm_output_pool()
+
     logger.info("启动Flask应用...")
-    app.run(debug=True, host='0.0.0.0', port=5011)
+    app.run(debug=debug, host='0.0.0.0', port=5011)